@@ -0,0 +1,138 @@
+# Decoded page backgrounds, already resized to the page and converted to the
+# page's mode (RGBA, or RGB and L for array pages). A process keeps the most
+# recently used ones in memory up to a byte budget. With a shared pool
+# directory (ideally on a tmpfs such as /dev/shm) the raw pixels are also
+# written there once and memory-mapped by every other process on the node,
+# so each texture is decoded once per node instead of once per page.
+#
+# The pool holds one raw file per background, page size and mode, width *
+# height * 4 bytes for RGBA: about 15 MiB for A4 at 200 DPI, and
+# random_generate.py samples a new DPI for every job. It is kept under its
+# own byte budget, deleting the least recently used files first, with file
+# mtimes as the order every process on the node agrees on.
+
+import hashlib
+import mmap
+import os
+from collections import OrderedDict
+
+from PIL import Image
+
+import procedural_backgrounds
+
+DEFAULT_BUDGET_MB = 512
+DEFAULT_POOL_BUDGET_MB = 4096
+
+class BackgroundCache:
+  def __init__(self, budget_mb=DEFAULT_BUDGET_MB, pool_dir=None, pool_budget_mb=DEFAULT_POOL_BUDGET_MB):
+    self.budget = int(budget_mb * 2 ** 20)
+    self.pool_dir = pool_dir
+    self.pool_budget = int(pool_budget_mb * 2 ** 20)
+    self.entries = OrderedDict()
+    self.used = 0
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, path, width, height, mode="RGBA"):
+    "A fresh `mode` page of `path` resized to (`width`, `height`)"
+    key = (path, width, height, mode)
+    try:
+      img = self.entries[key]
+      self.entries.move_to_end(key)
+      self.hits += 1
+    except KeyError:
+      self.misses += 1
+      img = self.load(path, width, height, mode)
+      self.entries[key] = img
+      self.used += width * height * len(mode)
+      while self.used > self.budget and len(self.entries) > 1:
+        _, evicted = self.entries.popitem(last=False)
+        self.used -= evicted.width * evicted.height * len(evicted.mode)
+    # pages are drawn on in place, so never hand out the cached one
+    return img.copy()
+
+  def load(self, path, width, height, mode="RGBA"):
+    if self.pool_dir is None:
+      return decode(path, width, height, mode)
+    pool_path = os.path.join(self.pool_dir, pool_name(path, width, height, mode))
+    try:
+      # marks the file as recently used for trim_pool
+      os.utime(pool_path)
+      return map_raw(pool_path, width, height, mode)
+    except FileNotFoundError:
+      pass
+    img = decode(path, width, height, mode)
+    os.makedirs(self.pool_dir, exist_ok=True)
+    tmp_path = f'{pool_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(img.tobytes())
+    os.replace(tmp_path, pool_path)
+    self.trim_pool()
+    return img
+
+  def trim_pool(self):
+    """Delete the least recently used files of the pool until it fits its
+    budget. Pages already mapped from a deleted file keep their pixels."""
+    files = []
+    with os.scandir(self.pool_dir) as entries:
+      for entry in entries:
+        if entry.name.endswith('.tmp'):
+          continue
+        try:
+          stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    used = sum(size for _, size, _ in files)
+    for _, size, pool_path in sorted(files):
+      if used <= self.pool_budget:
+        break
+      try:
+        os.remove(pool_path)
+      except FileNotFoundError:
+        pass
+      used -= size
+
+  def stats(self):
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'cached': len(self.entries),
+            'mb': self.used / 2 ** 20}
+
+def decode(path, width, height, mode="RGBA"):
+  if procedural_backgrounds.is_procedural(path):
+    # rendered at the page size, nothing to resize
+    img = procedural_backgrounds.load(path, width, height)
+  else:
+    img = Image.open(path)\
+               .resize((width, height))
+  if mode == "RGBA":
+    return img.convert("RGBA")
+  # through RGBA, so the pixels are those of the RGBA page
+  return img.convert("RGBA").convert(mode)
+
+def pool_name(path, width, height, mode="RGBA"):
+  if procedural_backgrounds.is_procedural(path):
+    key = f'{path}:{procedural_backgrounds.VERSION}:{width}x{height}'
+  else:
+    stat = os.stat(path)
+    key = f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}:{width}x{height}'
+  if mode != "RGBA":
+    key += f':{mode}'
+  return f'{hashlib.sha1(key.encode()).hexdigest()}.{mode.lower()}'
+
+def map_raw(pool_path, width, height, mode="RGBA"):
+  with open(pool_path, 'rb') as f:
+    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  return Image.frombuffer(mode, (width, height), buffer, "raw", mode, 0, 1)
+
+def format_stats(stats):
+  return f"{stats['hits']} hits/{stats['misses']} misses ({stats['cached']} cached, {stats['mb']:.0f} MiB)"
+
+backgrounds = BackgroundCache()
+
+def configure(budget_mb=DEFAULT_BUDGET_MB, pool_dir=None, pool_budget_mb=DEFAULT_POOL_BUDGET_MB):
+  "Replace this process's cache, e.g. from a worker initializer"
+  global backgrounds
+  backgrounds = BackgroundCache(budget_mb, pool_dir, pool_budget_mb)
+  return backgrounds
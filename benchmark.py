@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# rough throughput figures for the synthesizer, run from the repository root
+# (main.py expects the `fonts` file there), e.g.
+#   ./benchmark.py compositing sources/some-book.txt --font fonts.d/some-font.ttf
+
+import argparse
+import glob
+import os
+import re
+import tempfile
+import time
+
+import demoji
+
+from PIL import Image, ImageChops, ImageDraw
+
+import main as synth
+import util
+import word_masks
+from font_cache import truetype
+
+def bench_compositing(args):
+  print(f'{"dpi":>4}  {"mode":<5} {"page":<5} {"pages/s":>8}')
+  for dpi in args.dpis:
+    for mode, page_mode in (('page', 'rgba'), ('line', 'rgba'), ('line', 'rgb'), ('line', 'gray')):
+      with tempfile.TemporaryDirectory() as output_dir:
+        argv = [args.path,
+                '--font', args.font,
+                '--dpi', str(dpi),
+                '--end-page', str(args.pages),
+                '--compositing', mode,
+                '--page-mode', page_mode,
+                '--output-dir', output_dir]
+        if args.background:
+          argv += ['--background', args.background]
+        start = time.perf_counter()
+        synth.main(synth.get_parser().parse_args(argv))
+        elapsed = time.perf_counter() - start
+        pages = len(glob.glob(os.path.join(output_dir, '*', '*.png')))
+      print(f'{dpi:>4}  {mode:<5} {page_mode:<5} {pages / elapsed:8.2f}')
+
+def legacy_wrapped_text(text, font, line_length, delim=' '):
+  "get_wrapped_text as it was before word advances were cached"
+  lines = ['']
+  for word in text.split(delim):
+    line = f'{lines[-1]}{delim}{word}'.strip()
+    if font.getlength(line, direction="rtl") <= line_length:
+      lines[-1] = line
+    else:
+      lines.append(word)
+  return lines
+
+def bench_wrapping(args):
+  runs = [run for run in open(args.path, encoding='utf-8') if run.strip()]
+  runs.sort(key=len, reverse=True)
+  runs = runs[:args.paragraphs]
+  delim = '\u200c' if args.scriptio_continuo else ' '
+  if args.scriptio_continuo:
+    runs = [run.replace(' ', delim) for run in runs]
+  font = truetype(args.font, args.size)
+  chars = sum(map(len, runs))
+  # repeated delimiters give empty words, as in runs of spaces of generated
+  # numbers or of zero-width non-joiners with -sc
+  for case, case_runs in (('single', runs),
+                          ('repeated', [run.replace(delim, delim * 2) for run in runs])):
+    timings = {}
+    results = {}
+    for name, wrap in (('legacy', legacy_wrapped_text),
+                       ('cached', synth.get_wrapped_text)):
+      start = time.perf_counter()
+      results[name] = [wrap(run, font, args.line_length, delim) for run in case_runs]
+      timings[name] = time.perf_counter() - start
+    mismatches = sum(a != b for a, b in zip(results['legacy'], results['cached']))
+    for name, elapsed in timings.items():
+      print(f'{case:<8} {name:<7} {elapsed:8.3f}s {chars / elapsed:12.0f} chars/s')
+    print(f'{case:<8} {len(runs)} paragraphs, {mismatches} with different line breaks')
+  print(f'word advances: {synth.word_advance.cache_info()}')
+
+def bench_words(args):
+  font = truetype(args.font, args.size)
+  # lines are timed both ways here, not sampled
+  word_masks.configure(args.cache_mb, args.phases, sample_every=0)
+  lines = []
+  for run in open(args.path, encoding='utf-8'):
+    for line in synth.get_wrapped_text(run, font, args.line_length):
+      line, line_to_render = synth.prepare_line(line)
+      if line.strip():
+        lines.append((args.line_length - font.getlength(line_to_render), line_to_render))
+    if len(lines) >= args.lines:
+      break
+  lines = lines[:args.lines]
+  page = Image.new('RGBA', (args.line_length + 2 * args.size, 3 * args.size), (230, 220, 200, 255))
+  draw = ImageDraw.Draw(page)
+  fill = (0, 0, 0, 230)
+  results = {}
+  timings = {}
+  for mode in ('line', 'words'):
+    results[mode] = []
+    start = time.perf_counter()
+    for x, text in lines:
+      results[mode].append(synth.draw_line(page.copy(), draw, (args.size + x, args.size), text, font, fill, mode))
+    timings[mode] = time.perf_counter() - start
+  exact = 0
+  max_diff = 0
+  differing = 0
+  bbox_dev = 0.
+  for (line_img, line_bbox), (words_img, words_bbox) in zip(results['line'], results['words']):
+    changed = None
+    for band in ImageChops.difference(line_img, words_img).split():
+      max_diff = max(max_diff, band.getextrema()[1])
+      band = band.point(lambda v: 255 if v else 0)
+      changed = band if changed is None else ImageChops.lighter(changed, band)
+    pixels = changed.histogram()[255]
+    exact += pixels == 0
+    differing += pixels
+    bbox_dev = max(bbox_dev, max(abs(a - b) for a, b in zip(line_bbox, words_bbox)))
+  for mode, elapsed in timings.items():
+    print(f'{mode:<6} {elapsed:8.3f}s {len(lines) / elapsed:10.0f} lines/s')
+  print(f'speedup {timings["line"] / timings["words"]:.2f}x, word masks: {word_masks.format_stats(word_masks.masks.stats())}')
+  print(f'{exact}/{len(lines)} lines pixel-identical, max difference {max_diff}, '
+        f'{differing} differing pixels, max bbox deviation {bbox_dev:.3f}px')
+
+def legacy_preprocess(line):
+  "util.real_preprocess as it was before its rules were compiled"
+  line = util.remove_character_blocks(line)
+  line = line.replace('﴾', '(').replace('﴿', ')')
+  line = demoji.replace(line, '')
+  line = re.sub(r"[^\u0600-\u06ff\u0750-\u077f\uFE70-\uFEFF\uFB50-\uFDFF\u0870-\u089F\W\n]+\b", '' , line)
+  line = re.sub(r"^[\u064e\u064f\u0650\u064b\u064c\u064d\u0674]", '', line)
+  line = re.sub(r"\b[\u0621\u0674]\b", '', line)
+  return line
+
+def bench_normalize(args):
+  lines = []
+  for path in args.paths:
+    lines += open(path, encoding='utf-8').read().splitlines(keepends=True)
+  timings = {}
+  results = {}
+  for name, normalize in (('legacy', legacy_preprocess),
+                          ('compiled', util.real_preprocess)):
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+      results[name] = [normalize(line) for line in lines]
+    timings[name] = time.perf_counter() - start
+  mismatches = [line for line, a, b in zip(lines, results['legacy'], results['compiled']) if a != b]
+  for name, elapsed in timings.items():
+    print(f'{name:<9} {elapsed:8.3f}s {len(lines) * args.repeat / elapsed:12.0f} lines/s')
+  print(f'speedup {timings["legacy"] / timings["compiled"]:.2f}x, {len(lines)} lines, {len(mismatches)} different')
+  for line in mismatches[:10]:
+    print(f'  {line!r}')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Synthesizer benchmarks")
+  subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+  compositing = subparsers.add_parser('compositing',
+                                      help='Pages per second with page-sized vs line-sized text layers, and RGB/grayscale array pages')
+  compositing.add_argument('path', type=str, help='Path to a long txt source')
+  compositing.add_argument('--font', type=str, required=True, help='Path to font')
+  compositing.add_argument('--background', type=str, help='Path to folder of backgrounds')
+  compositing.add_argument('--pages', type=int, default=10, help='Pages to render per run')
+  compositing.add_argument('--dpis', type=int, nargs='+', default=[72, 100, 150, 200, 250],
+                           help='DPIs to measure, random_generate.py samples 72-250')
+  compositing.set_defaults(func=bench_compositing)
+
+  wrapping = subparsers.add_parser('wrapping',
+                                   help='Line wrapping speed and line breaks against the uncached wrapper')
+  wrapping.add_argument('path', type=str, help='Path to a txt source with long paragraphs')
+  wrapping.add_argument('--font', type=str, required=True, help='Path to font')
+  wrapping.add_argument('--size', type=int, default=50, help='Font size (px)')
+  wrapping.add_argument('--line-length', type=int, default=1300, help='Line length (px)')
+  wrapping.add_argument('--paragraphs', type=int, default=200, help='Number of longest paragraphs to wrap')
+  wrapping.add_argument('--scriptio-continuo', '-sc', action='store_true',
+                        help='Wrap on zero-width non-joiners like main.py -sc')
+  wrapping.set_defaults(func=bench_wrapping)
+
+  words = subparsers.add_parser('words',
+                                help='Lines per second from cached word masks against full-line rendering, and how far they differ')
+  words.add_argument('path', type=str, help='Path to a txt source')
+  words.add_argument('--font', type=str, required=True, help='Path to font')
+  words.add_argument('--size', type=int, default=50, help='Font size (px)')
+  words.add_argument('--line-length', type=int, default=1300, help='Line length (px)')
+  words.add_argument('--lines', type=int, default=2000, help='Number of lines to draw')
+  words.add_argument('--cache-mb', type=float, default=word_masks.DEFAULT_BUDGET_MB,
+                     help='Memory budget for cached word masks (MiB)')
+  words.add_argument('--phases', type=int, default=word_masks.DEFAULT_PHASES,
+                     help='Sub-pixel positions a word mask is cached for')
+  words.set_defaults(func=bench_words)
+
+  normalize = subparsers.add_parser('normalize',
+                                    help='util.real_preprocess against the uncompiled rules, speed and differing lines')
+  normalize.add_argument('paths', type=str, nargs='+', help='Text files to normalize line by line')
+  normalize.add_argument('--repeat', type=int, default=3, help='Passes over the lines')
+  normalize.set_defaults(func=bench_normalize)
+
+  args = parser.parse_args()
+  args.func(args)
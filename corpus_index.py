@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# Index of where every line starts in a folder of .txt sources. The offsets of
+# each file are kept on disk as a packed array behind a small header with the
+# size and mtime they were built from, so the index is refreshed by rescanning
+# only the files that changed, and a random line can be looked up by reading
+# eight bytes instead of the whole file.
+
+import argparse
+import glob
+import hashlib
+import os
+import random
+import struct
+from array import array
+
+CACHE_DIR = os.path.join('.cache', 'corpus-index')
+
+# size, mtime_ns and number of lines of the file the offsets were built from
+HEADER = struct.Struct('<QQQ')
+OFFSET = struct.Struct('<Q')
+
+def line_offsets(path):
+  "Byte offset of the start of every line in `path`"
+  offsets = array('Q')
+  position = 0
+  with open(path, 'rb') as f:
+    for line in f:
+      offsets.append(position)
+      position += len(line)
+  return offsets
+
+class CorpusIndex:
+  def __init__(self, root, cache_dir=CACHE_DIR):
+    self.root = root
+    self.cache_dir = cache_dir
+    self.paths = []
+    self.sizes = []
+    self.lines = []
+    self.rebuilt = 0
+
+  def cache_path(self, path):
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(self.cache_dir, f'{key}.offsets')
+
+  def read_header(self, path):
+    try:
+      with open(self.cache_path(path), 'rb') as f:
+        return HEADER.unpack(f.read(HEADER.size))
+    except (FileNotFoundError, struct.error):
+      return None
+
+  def build(self, path, stat):
+    offsets = line_offsets(path)
+    cache_path = self.cache_path(path)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(HEADER.pack(stat.st_size, stat.st_mtime_ns, len(offsets)))
+      offsets.tofile(f)
+    os.replace(tmp_path, cache_path)
+    self.rebuilt += 1
+    return len(offsets)
+
+  def refresh(self):
+    "Pick up new, changed and removed files under the root"
+    os.makedirs(self.cache_dir, exist_ok=True)
+    if os.path.isdir(self.root):
+      paths = sorted(glob.glob(os.path.join(self.root, '**/*.txt'), recursive=True))
+    else:
+      paths = [self.root]
+    self.paths, self.sizes, self.lines = [], [], []
+    for path in paths:
+      stat = os.stat(path)
+      header = self.read_header(path)
+      if header is not None and header[:2] == (stat.st_size, stat.st_mtime_ns):
+        lines = header[2]
+      else:
+        lines = self.build(path, stat)
+      if lines:
+        self.paths.append(path)
+        self.sizes.append(stat.st_size)
+        self.lines.append(lines)
+    return self
+
+  def restrict(self, keep):
+    "Leave out the files `keep(path)` is false for until the next refresh"
+    kept = [i for i, path in enumerate(self.paths) if keep(path)]
+    self.paths = [self.paths[i] for i in kept]
+    self.sizes = [self.sizes[i] for i in kept]
+    self.lines = [self.lines[i] for i in kept]
+    return self
+
+  def offset(self, path, line):
+    "Byte offset of line number `line` of `path`"
+    with open(self.cache_path(path), 'rb') as f:
+      f.seek(HEADER.size + line * OFFSET.size)
+      return OFFSET.unpack(f.read(OFFSET.size))[0]
+
+  def sample(self, window_lines=0, rng=random):
+    """A random (path, byte offset) to start rendering from.
+
+    Files are picked in proportion to their size and the start line
+    uniformly among those leaving `window_lines` lines after it, so long
+    books are not limited to their opening pages and short posts do not
+    weigh as much as books.
+    """
+    if not self.paths:
+      raise IndexError(f'Empty document set from path {self.root}')
+    i = rng.choices(range(len(self.paths)), weights=self.sizes)[0]
+    line = rng.randrange(max(1, self.lines[i] - window_lines))
+    return self.paths[i], self.offset(self.paths[i], line)
+
+  def __len__(self):
+    return len(self.paths)
+
+  def stats(self):
+    return {'files': len(self.paths),
+            'lines': sum(self.lines),
+            'mb': sum(self.sizes) / 2 ** 20,
+            'rebuilt': self.rebuilt}
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Build or refresh the line index of a folder of txt sources")
+  parser.add_argument('path', type=str, nargs='?', default='sources', help='Path to docs')
+  parser.add_argument('--cache-dir', type=str, default=CACHE_DIR, help='Where to keep the index')
+  args = parser.parse_args()
+  stats = CorpusIndex(args.path, args.cache_dir).refresh().stats()
+  print(f"{stats['files']} files, {stats['lines']} lines, {stats['mb']:.1f} MiB, {stats['rebuilt']} (re)indexed")
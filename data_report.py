@@ -1,15 +1,29 @@
 #!/usr/bin/env python
 
 # use this to clean up data that was generated but wasn't supposed to
-# i.e. the image likely contains blank characters
+# i.e. the image likely contains blank characters. Output directories are
+# reported by path, records of tar shards as <shard>.tar#<key>
 
 import os
 import json
 import glob
+import hashlib
+import argparse
+from multiprocessing import Pool, cpu_count
+
+from tqdm import tqdm
 
 from fontTools.ttLib import TTFont
 from fontTools.unicode import Unicode
 
+from font_cache import ttfont
+from glyph_coverage import missing_chars
+from synthetic_source import SyntheticSource
+
+CACHE_DIR = os.path.join('.cache', 'data-report')
+# sources of outputs rendered from synthesized text, see synthesized_source
+SYNTHESIZED = 'synthesized:'
+
 # https://stackoverflow.com/a/53829424
 def has_glyph(font, glyph):
   for table in font['cmap'].tables:
@@ -26,38 +40,69 @@ class FontNotFoundException(Exception):
     pass
 
 
-def check_font_on_text(font, text):
-  missing_chars = []
-  source_alphabet = set(text)
-  for char in source_alphabet:
-    if has_glyph(font, char) or char == '\n':
-      continue
-    else:
-      missing_chars.append(char)
-  return missing_chars
+def check_font_on_text(font_path, text):
+  return list(missing_chars(font_path, text))
 
 def path2font(font_path):
-  return TTFont(font_path)
+  return ttfont(font_path)
 def check_font_on_text_file(font_path, source_text_path):
-  font = path2font
-  text = open(source_text_path, encoding='utf-8').read()
-  return check_font_on_text(font, text)
+  return check_font_on_text(font_path, source_alphabet(source_text_path))
 
-def check_dir(dir_path):
+def source_alphabet(path, cache_dir=CACHE_DIR):
+  """Set of characters in the text at `path`. Kept on disk next to the size
+  and mtime of the file it was read from, so a source shared by many
+  outputs is only read again once it changes."""
+  if path.startswith(SYNTHESIZED):
+    return synthesized_alphabet(path)
+  stat = os.stat(path)
+  key = [stat.st_size, stat.st_mtime_ns]
+  cache_path = os.path.join(cache_dir, 'alphabets',
+                            f'{hashlib.sha1(os.path.abspath(path).encode()).hexdigest()}.json')
   try:
-    config_path = os.path.join(dir_path, 'config.json')
-    config = json.load(open(config_path, 'r'))
-  except FileNotFoundError:
-    raise ConfigNotFoundException
+    with open(cache_path, encoding='utf-8') as f:
+      entry = json.load(f)
+    if entry['stat'] == key:
+      return frozenset(entry['chars'])
+  except (FileNotFoundError, json.JSONDecodeError, KeyError):
+    pass
+  chars = set()
+  with open(path, encoding='utf-8') as f:
+    for block in iter(lambda: f.read(1 << 20), ''):
+      chars.update(block)
+  os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+  tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+  with open(tmp_path, 'w', encoding='utf-8') as f:
+    json.dump({'stat': key, 'chars': sorted(chars)}, f, ensure_ascii=False)
+  os.replace(tmp_path, cache_path)
+  return frozenset(chars)
 
+def synthesized_source(config):
+  "Source of a config with a generator, named after the generator and seed"
+  return f"{SYNTHESIZED}{config['generator']}:{config.get('seed')}"
+
+def synthesized_alphabet(source):
+  """Characters of a first chunk of the text a synthesized source's
+  generator makes with its seed, as random_generate.py checks fonts on"""
+  generator, _, seed = source[len(SYNTHESIZED):].rpartition(':')
+  sample = SyntheticSource(generator, seed=None if seed == 'None' else int(seed)).sample()
+  return frozenset(''.join(sample))
+
+def resolve_config(config):
+  """Font and source of an output's config, fixed up in place when they have
+  moved, and whether anything was fixed. The source of synthesized text is
+  `synthesized:<generator>:<seed>`."""
   resave = False
   
-  try:
-    source_alphabet = set(open(config['path'], encoding='utf-8').read())
-  except FileNotFoundError:
-    config['path'] = os.path.join('sources', config['path'])
-    source_alphabet = set(open(config['path'], encoding='utf-8').read())
-    resave = True
+  if config.get('generator') is not None:
+    # synthesized text has no source file to look for
+    source = synthesized_source(config)
+  else:
+    if not os.path.exists(config['path']):
+      config['path'] = os.path.join('sources', config['path'])
+      if not os.path.exists(config['path']):
+        raise FileNotFoundError(config['path'])
+      resave = True
+    source = config['path']
   try:
     font_path = config['font']
   except KeyError:
@@ -74,34 +119,165 @@ def check_dir(dir_path):
       resave = True
     else:
       raise FontNotFoundException
+
+  return font_path, source, resave
+
+def resolve_dir(dir_path):
+  """Font and source of an output directory, fixing up and resaving its
+  config when they have moved"""
+  try:
+    config_path = os.path.join(dir_path, 'config.json')
+    config = json.load(open(config_path, 'r'))
+  except FileNotFoundError:
+    raise ConfigNotFoundException
+
+  font_path, source_path, resave = resolve_config(config)
       
   if resave:
     with open(config_path, 'w') as f:
       json.dump(config, f)
 
-  return (check_font_on_text(font_path, config['path']),
-          config['font'], config['path'])
+  return font_path, source_path
 
-if __name__ == '__main__':
-  outputs = glob.glob('outputs/*')
-  
+def shard_configs(tar_path):
+  """(`<shard>#<key>`, config.json bytes) of every record of a tar shard,
+  read at the offsets its index gives, None for a record without one"""
+  with open(f'{tar_path}.index.json', encoding='utf-8') as f:
+    index = json.load(f)
+  with open(tar_path, 'rb') as f:
+    for record in index:
+      member = record['members'].get('config.json')
+      data = None
+      if member is not None:
+        offset, size = member
+        f.seek(offset)
+        data = f.read(size)
+      yield f'{tar_path}#{record["key"]}', data
+
+def record_shard(unit):
+  "The shard of a `<shard>#<key>` record"
+  return unit.partition('.tar#')[0] + '.tar'
+
+def resolve_shard(tar_path):
+  """resolve_or_mark for every record of a tar shard. The config of a shard
+  cannot be resaved, records of moved sources or fonts are only resolved.
+  Records of one document share their config, which is resolved once."""
+  resolved = {None: None}
+  records = []
+  for unit, data in shard_configs(tar_path):
+    if data not in resolved:
+      try:
+        resolved[data] = resolve_config(json.loads(data))[:2]
+      except (FontNotFoundException, FileNotFoundError):
+        resolved[data] = None
+    records.append((unit, resolved[data]))
+  return records
+
+def check_dir(dir_path):
+  font_path, source_path = resolve_dir(dir_path)
+  return (check_font_on_text(font_path, source_alphabet(source_path)),
+          font_path, source_path)
+
+def resolve_or_mark(dir_path):
+  """resolve_dir, or None when the directory is to be marked without a
+  check, like one whose config, font or source is gone"""
+  try:
+    return resolve_dir(dir_path)
+  except (ConfigNotFoundException, FontNotFoundException, FileNotFoundError):
+    return None
+
+def audit(dirs, shards=(), processes=cpu_count(), verbose=False):
+  """Report entry of every directory in `dirs` and of every record of the
+  tar shards in `shards`, by `<shard>#<key>`.
+
+  Configs are read by a pool of processes, then the alphabet of every
+  distinct source is built once, also in the pool, and checked against the
+  cached coverage of each font it was rendered with.
+  """
+  with Pool(processes=processes) as pool:
+    resolved = dict(zip(dirs, tqdm(pool.imap(resolve_or_mark, dirs, chunksize=64),
+                                   total=len(dirs), leave=False)))
+    for records in tqdm(pool.imap(resolve_shard, shards), total=len(shards), leave=False):
+      resolved.update(records)
+    sources = sorted({pair[1] for pair in resolved.values() if pair is not None})
+    alphabets = dict(zip(sources, pool.map(source_alphabet, sources)))
+  entries = {}
+  for dir_, pair in resolved.items():
+    if pair is None:
+      entries[dir_] = {'marked': True, 'incompatible': None}
+      continue
+    font, source_path = pair
+    missing = sorted(missing_chars(font, alphabets[source_path]))
+    entries[dir_] = {'marked': len(missing) > 0,
+                     'incompatible': {'font': font,
+                                      'text': source_path,
+                                      'missing': missing} if missing else None}
+    if verbose:
+      print(f'Done with "{dir_}"')
+  return entries
+
+def build_report(dirs, shards, state):
+  """data-report.json from the audited `state`, in the order of `dirs`
+  followed by the records of the sorted `shards` in their index order,
+  however many runs the entries were audited over"""
+  records = {}
+  for unit in state:
+    if '.tar#' in unit:
+      records.setdefault(record_shard(unit), []).append(unit)
   report = {'incompatible': [], 'marked': []}
+  for unit in [*dirs, *(unit for shard in sorted(shards) for unit in records.get(shard, []))]:
+    entry = state[unit]
+    if entry['marked']:
+      report['marked'].append(unit)
+    if entry['incompatible'] is not None:
+      report['incompatible'].append(entry['incompatible'])
+  return report
+
+def load_state(state_path):
+  try:
+    with open(state_path, encoding='utf-8') as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return {}
+
+def save_state(state_path, state):
+  os.makedirs(os.path.dirname(state_path) or '.', exist_ok=True)
+  with open(f'{state_path}.tmp', 'w', encoding='utf-8') as f:
+    json.dump(state, f, ensure_ascii=False)
+  os.replace(f'{state_path}.tmp', state_path)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Mark outputs rendered with fonts missing characters of their text")
+  parser.add_argument('outputs', type=str, nargs='?', default='outputs', help='Path to output directories and tar shards')
+  parser.add_argument('--report', type=str, default='data-report.json', help='Where to write the report')
+  parser.add_argument('--state', type=str, default=os.path.join(CACHE_DIR, 'state.json'),
+                      help='Where results of audited directories are kept for the next run')
+  parser.add_argument('--force', action='store_true', help='Audit every directory and shard again')
+  parser.add_argument('--batch-size', '-b', type=int, default=cpu_count(),
+                      help='Number of worker processes')
+  parser.add_argument("--verbose", action="store_true", help="Print every audited directory")
+  args = parser.parse_args()
+
+  outputs = glob.glob(os.path.join(args.outputs, '*'))
+  dirs = [path for path in outputs if os.path.isdir(path)]
+  dir_set = set(dirs)
+  # a shard gets its index once it is complete, those still being written
+  # are left to a later run
+  shards = {path for path in outputs
+            if path.endswith('.tar') and os.path.exists(f'{path}.index.json')}
+  # results of directories and shards that are gone are dropped
+  state = {} if args.force else load_state(args.state)
+  state = {unit: entry for unit, entry in state.items()
+           if unit in dir_set or record_shard(unit) in shards}
+  audited_shards = {record_shard(unit) for unit in state if '.tar#' in unit}
+  new_dirs = [dir_ for dir_ in dirs if dir_ not in state]
+  new_shards = sorted(shards - audited_shards)
+  state.update(audit(new_dirs, new_shards, min(args.batch_size, cpu_count()), args.verbose))
+  save_state(args.state, state)
+  print(f'{len(new_dirs)} directories and {len(new_shards)} shards audited, '
+        f'{len(dirs) - len(new_dirs)} and {len(shards) - len(new_shards)} from earlier runs')
   
-  for dir_ in outputs:
-    try:
-      missing_chars, font, source_path = check_dir(dir_)
-      if len(missing_chars) > 0:
-        report['marked'].append(dir_)
-        report['incompatible'].append({
-          'font': font,
-          'text': source_path,
-          'missing': list(missing_chars)
-        })
-    except ConfigNotFoundException:
-      report['marked'].append(dir_)
-    except FontNotFoundException:
-      report['marked'].append(dir_)
-    print(f'Done with "{dir_}"')
+  report = build_report(dirs, shards, state)
     
-  with open('data-report.json', 'w') as f:
+  with open(args.report, 'w') as f:
     json.dump(report, f)
@@ -0,0 +1,34 @@
+# Per-process caches for loaded fonts. Every render in a worker goes through
+# these, so a face is only built once per (path, pixel size) and a font file
+# only parsed once per path.
+
+from functools import lru_cache
+
+from PIL import ImageFont
+from fontTools.ttLib import TTFont
+
+FACE_CACHE_SIZE = 128
+PARSED_CACHE_SIZE = 32
+
+@lru_cache(maxsize=FACE_CACHE_SIZE)
+def truetype(font_path, size):
+  "FreeType face of `font_path` at `size` pixels"
+  return ImageFont.truetype(font_path, size=size)
+
+@lru_cache(maxsize=PARSED_CACHE_SIZE)
+def ttfont(font_path):
+  "fontTools parse of `font_path`"
+  return TTFont(font_path)
+
+def cache_stats():
+  stats = {}
+  for name, cache in (('faces', truetype), ('parsed', ttfont)):
+    info = cache.cache_info()
+    stats[name] = {'hits': info.hits,
+                   'misses': info.misses,
+                   'size': info.currsize}
+  return stats
+
+def format_stats(stats):
+  return ', '.join(f"{name} {s['hits']} hits/{s['misses']} misses ({s['size']} cached)"
+                   for name, s in stats.items())
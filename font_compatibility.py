@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# Share of the lines of every source a font can render. `process_txt` skips
+# the lines a font is missing characters of, so a font and a source that
+# mostly disagree produce few or no pages. Rendering jobs are only planned
+# for pairs whose share reaches a threshold.
+#
+# Counts are kept per source under .cache/font-compatibility, next to the
+# size and mtime of the source and keyed by font hash, so a source is only
+# read again once it changes or a new font is added.
+
+import argparse
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+
+from corpus_index import CorpusIndex
+from glyph_coverage import find_fonts, font_coverage, font_hash
+from util import real_preprocess
+
+CACHE_DIR = os.path.join('.cache', 'font-compatibility')
+
+# characters real_preprocess maps to others instead of only deleting
+MAPPED = frozenset('﴾﴿')
+
+def count_covered(source, font_paths):
+  """Number of non-blank lines of `source`, and for each font the number of
+  those it is not missing any character of after real_preprocess."""
+  with open(source, encoding='utf-8') as f:
+    return count_lines_covered(f, font_paths)
+
+def count_lines_covered(lines, font_paths):
+  """`count_covered` for any iterable of lines.
+
+  A line whose raw characters every font has needs no preprocessing, since
+  real_preprocess only deletes characters (or maps the ornate parentheses).
+  """
+  coverages = [font_coverage(font_path) | {'\n'} for font_path in font_paths]
+  common = frozenset.intersection(*coverages) - MAPPED if coverages else frozenset()
+  count = 0
+  everywhere = 0
+  covered = [0] * len(font_paths)
+  for line in lines:
+    if not line.strip('\n'):
+      continue
+    count += 1
+    if common.issuperset(line):
+      everywhere += 1
+      continue
+    chars = set(real_preprocess(line))
+    for i, coverage in enumerate(coverages):
+      covered[i] += chars <= coverage
+  return count, {font_path: n + everywhere for font_path, n in zip(font_paths, covered)}
+
+class CompatibilityMatrix:
+  def __init__(self, font_paths, cache_dir=CACHE_DIR):
+    self.font_paths = list(font_paths)
+    self.cache_dir = cache_dir
+    self.hashes = {}
+    self.shares = {}
+    self.counted = 0
+
+  def cache_path(self, source):
+    key = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()
+    return os.path.join(self.cache_dir, f'{key}.json')
+
+  def read_entry(self, source, stat):
+    try:
+      with open(self.cache_path(source), encoding='utf-8') as f:
+        entry = json.load(f)
+      if entry['stat'] == stat:
+        return entry
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+      pass
+    return {'stat': stat, 'lines': 0, 'covered': {}}
+
+  def update(self, job):
+    "Count the lines of a source for the fonts its entry lacks, and save it"
+    source, entry, font_paths = job
+    lines, covered = count_covered(source, font_paths)
+    entry['lines'] = lines
+    entry['covered'].update((self.hashes[font_path], n) for font_path, n in covered.items())
+    cache_path = self.cache_path(source)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+      json.dump(entry, f)
+    os.replace(tmp_path, cache_path)
+    return source, entry
+
+  def refresh(self, sources, processes=1):
+    "Shares of every font on every source, counting only what is not cached"
+    os.makedirs(self.cache_dir, exist_ok=True)
+    self.hashes = {font_path: font_hash(font_path) for font_path in self.font_paths}
+    entries = {}
+    jobs = []
+    for source in sources:
+      stat = os.stat(source)
+      entry = self.read_entry(source, [stat.st_size, stat.st_mtime_ns])
+      todo = [font_path for font_path in self.font_paths
+              if self.hashes[font_path] not in entry['covered']]
+      if todo:
+        jobs.append((source, entry, todo))
+      else:
+        entries[source] = entry
+    if processes > 1 and len(jobs) > 1:
+      with Pool(processes=processes) as pool:
+        entries.update(pool.imap_unordered(self.update, jobs))
+    else:
+      entries.update(map(self.update, jobs))
+    self.counted = len(jobs)
+    self.shares = {source: {font_path: entry['covered'][self.hashes[font_path]] / entry['lines']
+                                       if entry['lines'] else 0.
+                            for font_path in self.font_paths}
+                   for source, entry in entries.items()}
+    return self
+
+  def share(self, source, font_path):
+    "Share of the non-blank lines of `source` that `font_path` has every character of"
+    return self.shares[source][font_path]
+
+  def fonts_for(self, source, threshold):
+    "Fonts rendering at least `threshold` of the lines of `source`"
+    return [font_path for font_path, share in self.shares[source].items() if share >= threshold]
+
+  def stats(self, threshold):
+    pairs = sum(len(self.fonts_for(source, threshold)) for source in self.shares)
+    return {'sources': len(self.shares),
+            'fonts': len(self.font_paths),
+            'pairs': pairs,
+            'incompatible': len(self.shares) * len(self.font_paths) - pairs,
+            'counted': self.counted}
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Share of the lines of every source each font can render")
+  parser.add_argument('path', type=str, nargs='?', default='sources', help='Path to docs')
+  parser.add_argument('--fonts', type=str, default='fonts.d', help='Path to fonts')
+  parser.add_argument('--min-coverage', type=float, default=0.9,
+                      help='Share of lines at which a font and a source are compatible')
+  parser.add_argument('--cache-dir', type=str, default=CACHE_DIR, help='Where to keep the counts')
+  parser.add_argument('--batch-size', '-b', type=int, default=1,
+                      help='Number of worker processes counting sources')
+  parser.add_argument("--verbose", action="store_true", help="Print the share of every pair")
+  args = parser.parse_args()
+  sources = CorpusIndex(args.path).refresh().paths
+  matrix = CompatibilityMatrix(find_fonts(args.fonts), args.cache_dir).refresh(sources, args.batch_size)
+  if args.verbose:
+    for source in sources:
+      for font_path in matrix.font_paths:
+        print(f'{matrix.share(source, font_path):7.1%} {font_path} {source}')
+  stats = matrix.stats(args.min_coverage)
+  print(f"{stats['pairs']} compatible and {stats['incompatible']} incompatible pairs of "
+        f"{stats['sources']} sources and {stats['fonts']} fonts, {stats['counted']} sources (re)counted")
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+# Character datasets as packed atlases. Every character of a .chars file is
+# rendered in every font and size into a few large images, and a single
+# index.json maps each (character, font, size) to its rectangle, instead of
+# one folder per character holding one tiny PNG per crop.
+#
+# The atlases hold coverage (glyph white on black), so they can be tinted and
+# blended onto any background when the dataset is read.
+
+import argparse
+import json
+import os
+
+from PIL import Image
+from docx.shared import Pt
+
+from font_cache import truetype
+from glyph_coverage import find_fonts, missing_chars
+from main import tatwil, tatwil_width, to_px
+
+ATLAS_SIZE = 2048
+
+def read_chars(path):
+  "The entries of a .chars file, one per line, in order and without repeats"
+  chars = []
+  for line in open(path, encoding='utf-8'):
+    line = line.strip().replace('\u200f', '')
+    if line and line not in chars:
+      chars.append(line)
+  return chars
+
+def render_glyph(font, text):
+  """Coverage image of `text` cut to its bbox, and the bbox at the origin.
+
+  The text is shaped and rasterized once, the bbox is the mask's. Tatwil
+  only forces the joining form of its neighbour, so one at the start (drawn
+  rightmost) or the end (drawn leftmost) is cut off.
+  """
+  mask, (mask_left, mask_top) = font.getmask2(text, 'L', direction="rtl")
+  mask = Image.Image()._new(mask)
+  left, top = mask_left, mask_top
+  right, bottom = left + mask.width, top + mask.height
+  if tatwil in text:
+    width = tatwil_width(font)
+    if text.startswith(tatwil):
+      right -= width
+    if text.endswith(tatwil):
+      left += width
+  bbox = left, top, right, bottom
+  if right <= left or bottom <= top:
+    return None, bbox
+  return mask.crop((left - mask_left, top - mask_top,
+                    right - mask_left, bottom - mask_top)), bbox
+
+class AtlasPacker:
+  """Packs glyphs row by row into `size`x`size` atlases under `output_dir`.
+
+  An atlas is written as soon as the next one is started, so only one is
+  held in memory.
+  """
+  def __init__(self, output_dir, size=ATLAS_SIZE, padding=1):
+    self.output_dir = output_dir
+    self.size = size
+    self.padding = padding
+    self.names = []
+    self.atlas = None
+    os.makedirs(output_dir, exist_ok=True)
+
+  def new_atlas(self):
+    self.flush()
+    self.names.append(f'atlas-{len(self.names):05d}.png')
+    self.atlas = Image.new('L', (self.size, self.size))
+    self.x = self.y = self.row_height = 0
+
+  def add(self, img):
+    "Place `img` and return (atlas index, x, y)"
+    width, height = img.width + self.padding, img.height + self.padding
+    if width > self.size or height > self.size:
+      raise ValueError(f'Glyph of {img.width}x{img.height} does not fit a {self.size}px atlas')
+    if self.atlas is None:
+      self.new_atlas()
+    if self.x + width > self.size:
+      self.x, self.y = 0, self.y + self.row_height
+      self.row_height = 0
+    if self.y + height > self.size:
+      self.new_atlas()
+    x, y = self.x, self.y
+    self.atlas.paste(img, (x, y))
+    self.x += width
+    self.row_height = max(self.row_height, height)
+    return len(self.names) - 1, x, y
+
+  def flush(self):
+    if self.atlas is not None:
+      self.atlas.save(os.path.join(self.output_dir, self.names[-1]))
+      self.atlas = None
+
+def build_atlas(chars_path, font_paths, sizes, output_dir, dpi=200, atlas_size=ATLAS_SIZE, verbose=False):
+  chars = read_chars(chars_path)
+  packer = AtlasPacker(output_dir, atlas_size)
+  glyphs = []
+  missing = {}
+  for font_path in font_paths:
+    absent = set(missing_chars(font_path, ''.join(chars)))
+    if absent:
+      missing[font_path] = sorted(absent)
+    supported = [text for text in chars if absent.isdisjoint(text)]
+    rendered = []
+    for size in sizes:
+      font = truetype(font_path, to_px(Pt(size), dpi))
+      for text in supported:
+        img, bbox = render_glyph(font, text)
+        if img is not None:
+          rendered.append((text, size, img, bbox))
+    # tallest first keeps the rows of an atlas evenly filled
+    rendered.sort(key=lambda glyph: glyph[2].height, reverse=True)
+    for text, size, img, (left, top, _, _) in rendered:
+      atlas, x, y = packer.add(img)
+      glyphs.append({"char": text,
+                     "font": font_path,
+                     "size": size,
+                     "atlas": atlas,
+                     "rect": [x, y, img.width, img.height],
+                     "offset": [left, top]})
+    if verbose:
+      print(f'[INFO] {len(rendered)} glyphs from \'{font_path}\'')
+    if absent:
+      print(f'[WARN] Font "{font_path}" missing these characters {sorted(absent)}')
+  packer.flush()
+  index = {"source": chars_path,
+           "dpi": dpi,
+           "atlas_size": atlas_size,
+           "atlases": packer.names,
+           "glyphs": glyphs,
+           "missing": missing}
+  index_path = os.path.join(output_dir, 'index.json')
+  with open(f'{index_path}.tmp', 'w', encoding='utf-8') as f:
+    json.dump(index, f, ensure_ascii=False)
+  os.replace(f'{index_path}.tmp', index_path)
+  return index
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Render a .chars file across fonts and sizes into packed glyph atlases")
+  parser.add_argument('path', type=str, help='Path to .chars file')
+  parser.add_argument('--fonts', type=str, nargs='+', default=['fonts.d'],
+                      help='Font files or folders of fonts')
+  parser.add_argument('--sizes', type=int, nargs='+', default=list(range(17, 30)),
+                      help='Font sizes (pt)')
+  parser.add_argument('--dpi', type=int, default=200)
+  parser.add_argument('--atlas-size', type=int, default=ATLAS_SIZE, help='Atlas width and height (px)')
+  parser.add_argument("--output-dir", "-o", type=str, help="Path to output directory", default='outputs')
+  parser.add_argument("--verbose", action="store_true", help="Print info")
+  args = parser.parse_args()
+  font_paths = []
+  for font in args.fonts:
+    font_paths += find_fonts(font) if os.path.isdir(font) else [font]
+  dest_folder = os.path.join(args.output_dir,
+                             f'{os.path.basename(args.path)}.atlas.d')
+  index = build_atlas(args.path, font_paths, args.sizes, dest_folder,
+                      args.dpi, args.atlas_size, args.verbose)
+  print(f'{len(index["glyphs"])} glyphs in {len(index["atlases"])} atlases under \'{dest_folder}\'')
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Index of the characters each font has a glyph for. The set is read from
+# the cmap once per font file and cached on disk under the hash of the file,
+# so checking a text is a single set difference instead of a cmap scan per
+# character.
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+
+from font_cache import ttfont
+
+CACHE_DIR = os.path.join('.cache', 'glyph-coverage')
+
+_coverage = {}
+
+def font_hash(font_path):
+  digest = hashlib.sha1()
+  with open(font_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def read_cmap(font_path):
+  "Every character mapped by any cmap subtable of the font"
+  chars = set()
+  for table in ttfont(font_path)['cmap'].tables:
+    chars.update(map(chr, table.cmap.keys()))
+  return frozenset(chars)
+
+def font_coverage(font_path, cache_dir=CACHE_DIR):
+  "Set of characters `font_path` has a glyph for"
+  try:
+    return _coverage[font_path]
+  except KeyError:
+    pass
+  cache_path = os.path.join(cache_dir, f'{font_hash(font_path)}.json')
+  try:
+    with open(cache_path, encoding='utf-8') as f:
+      chars = frozenset(json.load(f))
+  except (FileNotFoundError, json.JSONDecodeError):
+    chars = read_cmap(font_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # several workers may build the same entry, the rename keeps it whole
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+      json.dump(sorted(chars), f, ensure_ascii=False)
+    os.replace(tmp_path, cache_path)
+  _coverage[font_path] = chars
+  return chars
+
+def missing_chars(font_path, text, ignore=frozenset('\n')):
+  "Characters of `text` the font has no glyph for"
+  return set(text) - font_coverage(font_path) - ignore
+
+def find_fonts(font_dir):
+  return sorted(glob.glob(os.path.join(font_dir, '**/*.ttf'), recursive=True))
+
+def build_index(font_dir, cache_dir=CACHE_DIR):
+  "Coverage of every font under `font_dir`, keyed by font path"
+  return {font_path: font_coverage(font_path, cache_dir)
+          for font_path in find_fonts(font_dir)}
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Build the glyph coverage index of a font folder")
+  parser.add_argument('fonts', type=str, nargs='?', default='fonts.d', help='Path to fonts')
+  parser.add_argument('--cache-dir', type=str, default=CACHE_DIR, help='Where to keep the index')
+  args = parser.parse_args()
+  for font_path, chars in build_index(args.fonts, args.cache_dir).items():
+    print(f'{len(chars):>6} {font_path}')
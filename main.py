@@ -3,12 +3,15 @@
 from arabic_reshaper import ArabicReshaper
 from bidi.algorithm import get_display
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 
 import docx
 from docx.shared import Length, Inches, Pt, Mm, Emu
 
 import math
+import itertools
+
+import numpy as np
 
 # from pdfminer.high_level import extract_pages
 # from pdfminer.layout import LTTextContainer, LTChar, LTTextLine 
@@ -23,11 +26,19 @@ import shutil
 
 import time
 from datetime import datetime
-
-from data_report import check_font_on_text, path2font
+from dataclasses import dataclass, fields
+
+from data_report import check_font_on_text
+from font_cache import truetype
+import background_cache
+import procedural_backgrounds
+import word_masks
+from word_masks import splits_into_words
+from writer import make_writer, format_stats
+from outputs import DirectoryOutput, LineCrops, make_output, to_project_dir, encode_page, write_page, document_config
 from util import real_preprocess, render_preprocess
 
-from functools import partial
+from functools import partial, lru_cache
 
 tatwil = 'ـ'
 
@@ -47,61 +58,355 @@ line_spacing_map = {
   "double": docx.enum.text.WD_LINE_SPACING.DOUBLE,
 }
 
-DEFAULT = {
-  # "spacing": Inches(0.5),
-  # "spacing rule": 1,
-  # "font": "Calibri",
-  # "font size": Pt(12),
-  # "page height": Mm(297),
-  # "page width": Mm(210),
-  # "left margin": Inches(1),
-  # "right margin": Inches(1),
-  # "top margin": Inches(1),
-  # "bottom margin": Inches(1),
-}
-
-backrounds = []
-
-to_project_dir = lambda path, output_dir : os.path.join(output_dir, f"{os.path.basename(path)}.{datetime.now().timestamp()}.d")
-
-def save(img, bboxes, dest_folder, page_number, verbose=False):
-  img_filename = os.path.join(dest_folder,  f'{page_number}.png')
-  json_filename = os.path.join(dest_folder,  f'{page_number}.json')
-  img.save(img_filename)
-  with open(json_filename, 'w') as f:
-    json.dump(bboxes, f, ensure_ascii=False)
-    if verbose:
-      print(f'[INFO] Saved \'{img_filename}\'')
-
-
-def create_page(page_width, page_height, bg=False):
-  global backgrounds
-  if bg:
+@dataclass
+class RenderConfig:
+  """Everything `process_txt` needs to lay out and render a text file.
+
+  Lengths use the same units as the command line: points for the font size,
+  inches for spacing and margins, millimetres for the page.
+  """
+  font: str = 'Calibri'
+  font_size: int = 12
+  spacing: float = 0.5
+  spacing_rule: str = 'single'
+  min_alpha: float = 0.85
+  max_alpha: float = 1.0
+  left_margin: float = 1
+  right_margin: float = 1
+  top_margin: float = 1
+  bottom_margin: float = 1
+  page_width: float = 210
+  page_height: float = 297
+  dpi: int = 200
+  background: str = None
+  output_dir: str = 'outputs'
+  start_page: int = 0
+  end_page: float = math.inf
+  # byte offset of the first line to render, see corpus_index.py
+  start_offset: int = 0
+  compositing: str = 'line'
+  # 'rgba' pages are PIL images; 'rgb' and 'gray' pages are uint8 arrays
+  # blended in place and written as RGB or grayscale PNGs
+  page_mode: str = 'rgba'
+  scriptio_continuo: bool = False
+  warn: bool = False
+  verbose: bool = False
+  # generator and seed of synthesized text, recorded instead of a source
+  # path, see synthetic_source.py
+  generator: str = None
+  seed: int = None
+
+  def __post_init__(self):
+    if self.verbose:
+      self.warn = True
+    if self.page_mode != 'rgba' and self.compositing == 'page':
+      raise ValueError(f'Page compositing needs RGBA pages, not {self.page_mode}')
+
+  @classmethod
+  def from_args(cls, args):
+    names = {field.name for field in fields(cls)}
+    config = cls(**{k: v for k, v in vars(args).items() if k in names})
+    if getattr(args, 'alpha', None):
+      config.min_alpha = args.alpha
+      config.max_alpha = args.alpha
+    if getattr(args, 'margin', None):
+      config.bottom_margin = args.margin
+      config.top_margin = args.margin
+      config.right_margin = args.margin
+      config.left_margin = args.margin
+    return config
+
+  def page_geometry(self):
+    "Page width, height and left, right, top, bottom margins in pixels"
+    return tuple(map(partial(to_px, dpi=self.dpi),
+                     (Mm(self.page_width),
+                      Mm(self.page_height),
+                      Inches(self.left_margin),
+                      Inches(self.right_margin),
+                      Inches(self.top_margin),
+                      Inches(self.bottom_margin))))
+
+  def line_spacing(self):
+    "Distance between consecutive lines in pixels"
+    return to_px(Emu(Inches(self.spacing) \
+                     * line_spacing_rules[line_spacing_map[self.spacing_rule]]),
+                 self.dpi)
+
+  def font_px(self):
+    return to_px(Pt(self.font_size), self.dpi)
+
+  def layout_key(self):
+    "What `layout_txt` depends on, configs with equal keys lay out alike"
+    return (self.font, self.font_px(), self.page_geometry(), self.line_spacing(),
+            self.scriptio_continuo, self.end_page)
+
+def save(img, bboxes, dest_folder, page_number, verbose=False, writer=None):
+  """Encode and write a finished page, on `writer`'s threads if given.
+
+  The page must not be drawn on after it is handed over.
+  """
+  encode = partial(encode_page, img, bboxes)
+  write = partial(write_page,
+                  dest_folder=dest_folder,
+                  page_number=page_number,
+                  verbose=verbose)
+  if writer is None:
+    write(encode())
+  else:
+    writer.submit(encode, write)
+
+
+def list_backgrounds(background):
+  """Backgrounds to pick pages from, given a folder of out*.png, a single
+  image or procedural textures (see procedural_backgrounds.py)"""
+  if not background:
+    return []
+  if procedural_backgrounds.is_procedural(background):
+    return procedural_backgrounds.expand(background)
+  if os.path.isfile(background):
+    return [background]
+  return glob.glob(os.path.join(background, 'out*.png'))
+
+# modes pages are kept in, see RenderConfig.page_mode
+PAGE_MODES = {'rgba': "RGBA", 'rgb': "RGB", 'gray': "L"}
+
+def create_page(page_width, page_height, backgrounds=(), page_mode='rgba'):
+  """A fresh page on a random background, its ImageDraw and an empty bbox list.
+
+  With `page_mode` 'rgb' or 'gray' the page is a uint8 array of that many
+  channels instead, and the ImageDraw is None.
+  """
+  mode = PAGE_MODES[page_mode]
+  if backgrounds:
     background = random.choice(backgrounds)
-    img = Image.open(background)\
-               .resize((page_width, page_height))\
-               .convert("RGBA")
+    img = background_cache.backgrounds.get(background, page_width, page_height, mode)
   else:
-    img = Image.new("RGBA",
+    img = Image.new(mode,
                     tuple(map(int,
                               (page_width,
                                page_height))),
                     color="white")
+  if page_mode != 'rgba':
+    return np.array(img), None, []
   draw = ImageDraw.Draw(img)
   return img, draw, []
 
+@lru_cache(maxsize=1 << 10)
+def tatwil_width(font):
+  "Width of the tatwil's bbox, trimmed off characters drawn with it"
+  left, _, right, _ = font.getbbox(tatwil, direction="rtl")
+  return right - left
+
+def draw_line(img, draw, xy, text, font, fill, compositing='line'):
+  """Blend one line of text onto `img` and return the new page with its bbox.
+
+  With `compositing='page'` the line goes on a page-sized layer which is then
+  blended over the whole page. With `compositing='line'` the line is shaped
+  and rasterized once into a coverage mask, the bbox is taken from that same
+  mask, and the mask is blended in place over the region it covers, which
+  gives the same pixels and bbox for a fraction of the work. With
+  `compositing='words'` the line is assembled from cached word masks where
+  possible, see `draw_words`.
+  """
+  if compositing == 'words' and splits_into_words(text):
+    if not word_masks.masks.sample_line():
+      return draw_words(img, xy, text, font, fill)
+    return draw_words_timed(img, xy, text, font, fill)
+  if compositing == 'page':
+    bbox = draw.textbbox(xy, text,
+                         font=font,
+                         direction="rtl")
+    txt_im = Image.new('RGBA', img.size,
+                       (255,255,255,0))
+    txt_d = ImageDraw.Draw(txt_im)
+    txt_d.text(xy, text,
+               font=font,
+               fill=fill,
+               direction="rtl")
+    return Image.alpha_composite(img, txt_im), bbox
+  x, y = xy
+  # what ImageDraw.text does: rasterize at the fractional part of the
+  # position and place the mask from the truncated one
+  start = (math.modf(x)[0], math.modf(y)[0])
+  mask, (dx, dy) = font.getmask2(text, 'L', direction="rtl", start=start)
+  mask = Image.Image()._new(mask)
+  # textbbox's box, the mask has an extra row or column when rendered at a
+  # fractional start
+  bbox = (x + dx, y + dy,
+          x + (dx + mask.width - (start[0] > 0)),
+          y + (dy + mask.height - (start[1] > 0)))
+  return blend_mask(img, mask, (int(x) + dx, int(y) + dy), fill), bbox
+
+def blend_mask(img, mask, xy, fill):
+  """Blend `fill` through the coverage `mask` placed at `xy` onto `img`, in
+  place, giving the pixels of ImageDraw.text on a transparent layer"""
+  if isinstance(img, np.ndarray):
+    return blend_array(img, mask, xy, fill)
+  left, top = xy
+  if not mask.width or not mask.height \
+     or left + mask.width <= 0 or top + mask.height <= 0 \
+     or left >= img.width or top >= img.height:
+    return img
+  layer = Image.new('RGBA', mask.size, (255,255,255,0))
+  layer.paste(fill, (0, 0) + mask.size, mask)
+  img.alpha_composite(layer,
+                      dest=(max(0, left), max(0, top)),
+                      source=(max(0, -left), max(0, -top)))
+  return img
+
+def draw_words(img, xy, text, font, fill):
+  """Blend a right-to-left line onto `img` from cached word masks.
+
+  Words are placed from the right at the sum of the advances before them
+  and their masks merged like FreeType merges glyphs, keeping the brightest
+  coverage, before the line is blended in place as with line compositing.
+  The bbox is the union of the words' bboxes.
+  """
+  cache = word_masks.masks
+  x, y = xy
+  space = word_advance(font, ' ')
+  iy, phase_y = int(y), math.modf(y)[0]
+  placed = []
+  pen = x
+  for word in reversed(text.replace('\u200f', '').split(' ')):
+    if word:
+      ix, phase_x = cache.place(pen)
+      mask, (dx, dy) = cache.get(font, word, phase_x, phase_y)
+      if mask.width and mask.height:
+        # textbbox's box, the mask has an extra row or column when rendered
+        # at a fractional start
+        placed.append((mask, ix + dx, iy + dy,
+                       pen + dx, y + dy,
+                       pen + (dx + mask.width - (phase_x > 0)),
+                       y + (dy + mask.height - (phase_y > 0))))
+      pen += word_advance(font, word)
+    pen += space
+  if not placed:
+    return img, (x, y, x, y)
+  left = min(p[1] for p in placed)
+  top = min(p[2] for p in placed)
+  right = max(p[1] + p[0].width for p in placed)
+  bottom = max(p[2] + p[0].height for p in placed)
+  line_mask = Image.new('L', (right - left, bottom - top))
+  for mask, mx, my, *_ in placed:
+    box = (mx - left, my - top, mx - left + mask.width, my - top + mask.height)
+    line_mask.paste(ImageChops.lighter(line_mask.crop(box), mask), box)
+  bbox = (min(p[3] for p in placed), min(p[4] for p in placed),
+          max(p[5] for p in placed), max(p[6] for p in placed))
+  return blend_mask(img, line_mask, (left, top), fill), bbox
+
+def draw_words_timed(img, xy, text, font, fill):
+  """`draw_words`, timed against drawing the line whole onto a copy of the
+  region it covers, for the speedup reported with the word mask stats"""
+  start = time.perf_counter()
+  img, bbox = draw_words(img, xy, text, font, fill)
+  word_seconds = time.perf_counter() - start
+  x, y = xy
+  if bbox == (x, y, x, y):
+    # no word had a mask, e.g. a line of spaces, so there is nothing to compare
+    return img, bbox
+  left, top = max(0, math.floor(bbox[0]) - 2), max(0, math.floor(bbox[1]) - 2)
+  if isinstance(img, np.ndarray):
+    region = img[top:math.ceil(bbox[3]) + 2, left:math.ceil(bbox[2]) + 2].copy()
+  else:
+    region = img.crop((left, top, min(img.width, math.ceil(bbox[2]) + 2), min(img.height, math.ceil(bbox[3]) + 2)))
+  start = time.perf_counter()
+  draw_line(region, None, (x - left, y - top), text, font, fill)
+  word_masks.masks.add_timing(word_seconds, time.perf_counter() - start)
+  return img, bbox
+
+@lru_cache(maxsize=1 << 12)
+def layer_lut(fill, channels):
+  """Pixels of a transparent layer after `fill` is pasted through every
+  coverage value, as uint32 colour (`channels` of them) and alpha columns.
+
+  Taken from Pillow itself, since how it blends a colour into a fully
+  transparent pixel has changed between versions.
+  """
+  ramp = Image.new('L', (256, 1))
+  ramp.putdata(range(256))
+  layer = Image.new('RGBA', ramp.size, (255,255,255,0))
+  layer.paste(fill, (0, 0) + ramp.size, ramp)
+  if channels == 1:
+    color = layer.convert('RGB').convert('L')
+  else:
+    color = layer.convert('RGB')
+  lut = np.asarray(color, dtype=np.uint32).reshape(256, channels)
+  return lut, np.asarray(layer.getchannel('A'), dtype=np.uint32).reshape(256, 1)
+
+def blend_array(page, mask, xy, fill):
+  """`blend_mask` for an opaque RGB or grayscale uint8 array page.
+
+  Works out Image.alpha_composite's integer arithmetic for an opaque page
+  over the region the mask covers, so an RGB page gets the same pixels as
+  line compositing on an RGBA page.
+  """
+  left, top = xy
+  height, width = page.shape[:2]
+  x0, y0 = max(0, left), max(0, top)
+  x1, y1 = min(width, left + mask.width), min(height, top + mask.height)
+  if x1 <= x0 or y1 <= y0:
+    return page
+  coverage = np.asarray(mask)[y0 - top:y1 - top, x0 - left:x1 - left]
+  region = page[y0:y1, x0:x1]
+  channels = 1 if page.ndim == 2 else page.shape[2]
+  lut, alpha_lut = layer_lut(fill, channels)
+  color, alpha = lut[coverage], alpha_lut[coverage]
+  if page.ndim == 2:
+    color, alpha = color[..., 0], alpha[..., 0]
+  # alpha_composite with an opaque destination: coefficients sa * 128 and
+  # (255 - sa) * 128, then rounded division by 255 and the 7 precision bits
+  blended = (color * alpha + region * (255 - alpha)) * 128 + (0x80 << 7)
+  blended = (((blended >> 8) + blended) >> 8) >> 7
+  region[...] = np.where(alpha > 0, blended, region)
+  return page
+
+# lines are measured as the sum of their words' advances, which is exact
+# unless the font kerns or shapes across the delimiter; a candidate line whose
+# estimate lands this close to the limit is measured in full to settle it
+WRAP_TOLERANCE = 0.02
+
+@lru_cache(maxsize=1 << 16)
+def word_advance(font, word):
+  return font.getlength(word, direction="rtl")
+
 # from https://stackoverflow.com/a/67203353
 def get_wrapped_text(text: str,
                      font: ImageFont.ImageFont,
                      line_length: int,
                      delim=' '):
+  tolerance = WRAP_TOLERANCE * line_length
+  delim_width = word_advance(font, delim)
   lines = ['']
+  width = 0
   for word in text.split(delim):
     line = f'{lines[-1]}{delim}{word}'.strip()
-    if font.getlength(line, direction="rtl") <= line_length:
+    if line == lines[-1]:
+      # an empty word between repeated delimiters, stripped away; the line
+      # only breaks if it was already too long, as the measured line would
+      if width <= line_length - tolerance or font.getlength(line, direction="rtl") <= line_length:
+        continue
+      lines.append(word)
+      width = 0
+      continue
+    word_width = word_advance(font, word.strip())
+    if lines[-1]:
+      estimate = width + delim_width + word_width
+    else:
+      estimate = word_advance(font, line)
+    if estimate <= line_length - tolerance:
+      fits = True
+    elif estimate > line_length + tolerance:
+      fits = False
+    else:
+      estimate = font.getlength(line, direction="rtl")
+      fits = estimate <= line_length
+    if fits:
       lines[-1] = line
+      width = estimate
     else:
       lines.append(word)
+      width = word_width
   return lines
 
 
@@ -123,34 +428,38 @@ def get_font_name(style):
   else:
     return style.font.name
   
-def get_font(run, font_dict, dpi):
-  # Get the font size of the run
+def get_font(run, font_dict, config):
+  # Get the font size of the run, falling back to the configured one
   try:
-    run_font_size = get_font_size(run.style)
+    run_font_size = get_font_size(run.style) or Pt(config.font_size)
   except (TypeError, AttributeError):
-    run_font_size = DEFAULT["font-size"]
+    run_font_size = Pt(config.font_size)
 
   try:
-    run_font_name = get_font_name(to_px(run.style, dpi))
+    run_font_name = get_font_name(to_px(run.style, config.dpi))
   except (TypeError, AttributeError):
-    run_font_name = DEFAULT["font"]
+    run_font_name = config.font
     
-  return ImageFont.truetype(font_dict[run_font_name],
-                            to_px(run_font_size, dpi))
+  return truetype(font_dict[run_font_name],
+                  to_px(run_font_size, config.dpi))
+
+def default_spacing(config):
+  return Emu(Inches(config.spacing) \
+             * line_spacing_rules[line_spacing_map[config.spacing_rule]])
 
-def get_spacing(paragraph):
+def get_spacing(paragraph, config):
   try:
     if type(paragraph.paragraph_format.line_spacing) == float:
       try:
-        spacing = from_px(get_font_size(paragraph.style) * paragraph.paragraph_format.line_spacing, dpi)
+        spacing = from_px(get_font_size(paragraph.style) * paragraph.paragraph_format.line_spacing, config.dpi)
       except (TypeError, AttributeError, IndexError) as e:
-        spacing = Emu(DEFAULT["spacing"] * DEFAULT["spacing-rule"])
+        spacing = default_spacing(config)
     else:
       spacing = paragraph.paragraph_format.line_spacing * line_spacing_rules[
         paragraph.paragraph_format.line_spacing_rules
       ]
   except (TypeError, AttributeError) as e:
-    spacing = Emu(DEFAULT["spacing"] * DEFAULT["spacing-rule"])
+    spacing = default_spacing(config)
   return spacing
 
 def get_indents(paragraph):
@@ -162,34 +471,35 @@ def get_indents(paragraph):
     right_indent = Inches(0)
   return right_indent, left_indent
 
-def process_txt(args, font):
-  font_for_checking = path2font(args.font)
-  dest_folder = to_project_dir(args.path, args.output_dir)
-  os.makedirs(dest_folder, exist_ok=True)
+@lru_cache(maxsize=1 << 16)
+def prepare_line(line):
+  "The line as stored in the bboxes and as drawn, cached for variants of the same text"
+  line = real_preprocess(line)
+  return line, render_preprocess(line)
+
+def layout_txt(runs, config, font, path=None):
+  """Lay out the lines of a text file into pages without drawing anything.
+
+  Yields (page_number, placements) for every page `process_txt` saves, in
+  order, where each placement is (x, y, line, line_to_render). As in
+  `process_txt`, the last, unfinished page is never yielded. `path` is only
+  used in warnings.
+  """
   page_width, page_height,\
     left_margin, right_margin,\
-    top_margin, bottom_margin = map(partial(to_px, dpi=args.dpi),
-                                    (DEFAULT['page-width'],
-                                     DEFAULT['page-height'],
-                                     DEFAULT['left-margin'],
-                                     DEFAULT['right-margin'],
-                                     DEFAULT['top-margin'],
-                                     DEFAULT['bottom-margin']))
+    top_margin, bottom_margin = config.page_geometry()
   page_number = 0
-  # Iterate over each paragraph in the document
-  img, draw, bboxes = create_page(page_width, page_height, args.background)
+  placements = []
   
   cum_spacing = top_margin
   # Extract the text and style of the paragraph
-  par_spacing = to_px(Emu(DEFAULT['spacing'] \
-                          * line_spacing_rules[DEFAULT['spacing-rule']]),
-                      args.dpi)
+  par_spacing = config.line_spacing()
   right_indent = 0
   left_indent = 0
-  for j, run in enumerate(open(args.path, 'r')):
-    if page_number > args.end_page:
+  for j, run in enumerate(runs):
+    if page_number > config.end_page:
       break
-    if args.scriptio_continuo:
+    if config.scriptio_continuo:
       run = run.replace(' ', "\u200c")
     text = get_wrapped_text(run,
                             font,
@@ -198,7 +508,7 @@ def process_txt(args, font):
                             - left_margin \
                             - right_indent \
                             - left_indent,
-                            delim="\u200c" if args.scriptio_continuo else' ')
+                            delim="\u200c" if config.scriptio_continuo else' ')
     
     for k, line in enumerate(text):
       # if line 
@@ -211,79 +521,130 @@ def process_txt(args, font):
       if cum_spacing + font.size > page_height - bottom_margin:
         if page_number == 0:
           page_number += 1
-        save(img, bboxes, dest_folder, page_number, args.verbose)
-        img, draw, bboxes = create_page(page_width, page_height, args.background)
+        yield page_number, placements
+        placements = []
         cum_spacing = top_margin
         page_number += 1
-      if page_number > args.end_page:
+      if page_number > config.end_page:
         break
       y = cum_spacing
       if y > page_height:
-        if args.warn:
+        if config.warn:
           print(f"[WARN] Ran off page at line {line}\n")
         continue
       
-      line = real_preprocess(line)
-      line_to_render = render_preprocess(line)
+      line, line_to_render = prepare_line(line)
       # check first
-      missing_chars = check_font_on_text(font_for_checking, line)
+      missing_chars = check_font_on_text(config.font, line)
       if len(missing_chars) > 0:
-        if args.warn:
-          print(f'[WARN] Font "{args.font}" missing these characters {missing_chars} present in file \"{args.path}\". Skipping line...')
+        if config.warn:
+          print(f'[WARN] Font "{config.font}" missing these characters {missing_chars} present in file \"{path}\". Skipping line...')
         continue
       if len(line) == 0:
-        if args.warn:
+        if config.warn:
           print(f"[WARN] Empty line. Skipping...")
         continue
-      alpha = int(random.uniform(args.min_alpha, args.max_alpha) * 255)
-      txt_im = Image.new('RGBA', img.size,
-                         (255,255,255,0))
-      txt_d = ImageDraw.Draw(txt_im)
-      txt_d.text((x, y), line_to_render,
-                 font=font,
-                 fill=(0, 0, 0, alpha),
-                 direction="rtl")
-      bbox = draw.textbbox((x, y), line_to_render,
-                           font=font,
-                           direction="rtl")
-      img = Image.alpha_composite(img, txt_im)
-      bboxes.append({"text": line,
-                     "bbox": bbox})
+      placements.append((x, y, line, line_to_render))
       cum_spacing += par_spacing
-      # save(img, bboxes, dest_folder, page_number)
-  if page_number > 0:
-    with open(os.path.join(dest_folder, 'config.json'), 'w') as f:
-      json.dump(vars(args), f)
-  else:
-    shutil.rmtree(dest_folder)
 
-def process_chars(args, font):
+def render_page(placements, config, font, backgrounds=()):
+  "Draw one laid out page, returning the page and its bboxes"
+  page_width, page_height, *_ = config.page_geometry()
+  img, draw, bboxes = create_page(page_width, page_height, backgrounds, config.page_mode)
+  for x, y, line, line_to_render in placements:
+    alpha = int(random.uniform(config.min_alpha, config.max_alpha) * 255)
+    img, bbox = draw_line(img, draw, (x, y), line_to_render, font,
+                          (0, 0, 0, alpha), config.compositing)
+    bboxes.append({"text": line,
+                   "bbox": bbox})
+  return img, bboxes
+
+def render_layout(pages, path, config, font, output=None):
+  "Draw the laid out `pages` of `path` onto `output`, see `process_txt`"
+  backgrounds = list_backgrounds(config.background)
+  project = (output if output is not None else DirectoryOutput()).open(path, config)
+  produced = False
+  for page_number, placements in pages:
+    if page_number < config.start_page:
+      continue
+    img, bboxes = render_page(placements, config, font, backgrounds)
+    project.save_page(img, bboxes, page_number)
+    produced = True
+  return project.close(produced)
+
+def process_txt(path, config, font, output=None, max_lines=None):
+  """Render the text file at `path` into pages on `output` (see outputs.py).
+
+  `font` is the FreeType font for `config.font` at `config.font_px()`.
+  Without an output, pages are written synchronously to a project folder
+  under `config.output_dir`. Pages before `config.start_page` are only laid
+  out, so they cost wrapping and measuring but no drawing. At most
+  `max_lines` lines are read from `config.start_offset`, all of them when
+  it is 0 or None. Returns where the document went, or None if no page was
+  produced.
+  """
+  with open(path, 'r') as source:
+    source.seek(config.start_offset)
+    return process_lines(itertools.islice(source, max_lines or None), path, config, font, output)
+
+def process_lines(lines, path, config, font, output=None):
+  """`process_txt` for any iterable of lines, e.g. text generated on the fly.
+
+  Lines are only pulled as the layout needs them, so an endless source
+  stops being read once `config.end_page` is laid out. `path` only names
+  the document in the output and in warnings.
+  """
+  return render_layout(layout_txt(lines, config, font, path),
+                       path, config, font, output)
+
+def process_variants(path, configs, output=None, max_lines=None, lines=None):
+  """Render the same text of `path` once per config in `configs`.
+
+  The text is read once, from the first config's `start_offset` and at most
+  `max_lines` lines as in `process_txt`, and lines are preprocessed once. Configs that agree on
+  everything the layout depends on (see `RenderConfig.layout_key`) share
+  one layout, so they only differ in drawing: background, alpha and the
+  like. Returns where each variant went.
+
+  `lines`, if given, is rendered instead of the file, which then only names
+  the documents. It is read as far as the longest layout needs it.
+  """
+  if lines is None:
+    with open(path, 'r') as source:
+      source.seek(configs[0].start_offset)
+      lines = list(itertools.islice(source, max_lines or None))
+  keys = list(dict.fromkeys(config.layout_key() for config in configs))
+  runs = dict(zip(keys, itertools.tee(lines, len(keys))))
+  layouts = {}
+  results = []
+  for config in configs:
+    font = load_font(config)
+    key = config.layout_key()
+    if key not in layouts:
+      layouts[key] = list(layout_txt(runs[key], config, font, path))
+    results.append(render_layout(layouts[key], path, config, font, output))
+  return results
+
+def process_chars(path, config, font):
   # check first
-  missing_chars = check_font_on_text(args.font, args.path)
+  missing_chars = check_font_on_text(config.font,
+                                     open(path, encoding='utf-8').read())
   if len(missing_chars) > 0:
-    raise ValueError(f'Font "{args.font}" missing these characters {missing_chars} present in file \"{args.path}\"')
+    raise ValueError(f'Font "{config.font}" missing these characters {missing_chars} present in file \"{path}\"')
   
-  
-  dest_folder = to_project_dir(args.path, args.output_dir)
+  backgrounds = list_backgrounds(config.background)
+  dest_folder = to_project_dir(path, config.output_dir)
   os.makedirs(dest_folder, exist_ok=True)
   page_width, page_height,\
     left_margin, right_margin,\
-    top_margin, bottom_margin = map(partial(to_px, dpi=args.dpi),
-                                    (DEFAULT['page-width'],
-                                     DEFAULT['page-height'],
-                                     DEFAULT['left-margin'],
-                                     DEFAULT['right-margin'],
-                                     DEFAULT['top-margin'],
-                                     DEFAULT['bottom-margin']))
+    top_margin, bottom_margin = config.page_geometry()
   page_number = 1
   # Iterate over each paragraph in the document
-  img, draw, bboxes = create_page(page_width, page_height, args.background)
+  img, draw, bboxes = create_page(page_width, page_height, backgrounds)
   
   cum_spacing = top_margin
   # Extract the text and style of the paragraph
-  par_spacing = to_px(Emu(DEFAULT['spacing'] \
-                          * line_spacing_rules[DEFAULT['spacing-rule']]).
-                      args.dpi)
+  par_spacing = config.line_spacing()
   right_indent = 0
   left_indent = 0
   configuration = {
@@ -292,8 +653,8 @@ def process_chars(args, font):
     'RIAL SIGN': True,  # Replace ر ي ا ل with ﷼
   }
   reshaper = ArabicReshaper(configuration=configuration)
-  for j, run in enumerate(open(args.path, 'r')):
-    if page_number > args.end_page:
+  for j, run in enumerate(open(path, 'r')):
+    if page_number > config.end_page:
       break
     text = get_wrapped_text(run,
                             font,
@@ -308,42 +669,32 @@ def process_chars(args, font):
         - font.getlength(line)
       if cum_spacing + font.size > page_height - bottom_margin:
         # save(img, bboxes, dest_folder, page_number)
-        img, draw, bboxes = create_page(page_width, page_height, args.background)
+        img, draw, bboxes = create_page(page_width, page_height, backgrounds)
         cum_spacing = top_margin
         page_number += 1
-      if page_number > args.end_page:
+      if page_number > config.end_page:
         break
       y = cum_spacing
-      if args.warn and y > page_height:
+      if config.warn and y > page_height:
         print(f"[WARN] Ran off page at line {line}\n")
         # line = reshaper.reshape(get_display(line))
       
       line = u"\u200f" + line.replace('﴾', '(').replace('﴿', ')')
       
-      alpha = int(random.uniform(args.min_alpha, args.max_alpha) * 255)
-      txt_im = Image.new('RGBA', img.size,
-                         (255,255,255,0))
-      txt_d = ImageDraw.Draw(txt_im)
-      txt_d.text((x, y), line,
-                 font=font,
-                 fill=(0, 0, 0, alpha),
-                 direction="rtl")
-      left, top, right, bottom = draw.textbbox((x, y), line,
-                                               font=font,
-                                               direction="rtl")
+      alpha = int(random.uniform(config.min_alpha, config.max_alpha) * 255)
+      img, (left, top, right, bottom) = draw_line(img, draw, (x, y), line, font,
+                                                  fill=(0, 0, 0, alpha),
+                                                  compositing=config.compositing)
+      draw = ImageDraw.Draw(img)
       if tatwil in line:
-        left_t, _, right_t, _ = draw.textbbox((x, y), tatwil,
-                                              font=font,
-                                              direction="rtl")
-        tatwil_width = right_t - left_t
+        width = tatwil_width(font)
         if line.startswith(tatwil):
-          right -= tatwil_width
+          right -= width
         if line.endswith(tatwil):
-          left += tatwil_width
+          left += width
       char_path = os.path.join(dest_folder,
                                line.replace(tatwil, '').replace('\u200f', ''))
       os.makedirs(char_path, exist_ok=True)
-      img = Image.alpha_composite(img, txt_im)
       img.crop((left, top, right, bottom))\
          .save(os.path.join(char_path,
                             f'{datetime.now()}.png'))
@@ -352,17 +703,18 @@ def process_chars(args, font):
       cum_spacing += par_spacing
       # save(img, bboxes, dest_folder, page_number)
   with open(os.path.join(dest_folder, 'config.json'), 'w') as f:
-    json.dump(vars(args), f)
+    json.dump(document_config(path, config), f)
 
-def process_doc(args, font_dict):
-  dest_folder = to_project_dir(args.path, args.output_dir)
-  doc = docx.Document(doc_path)
+def process_doc(path, config, font_dict):
+  backgrounds = list_backgrounds(config.background)
+  dest_folder = to_project_dir(path, config.output_dir)
+  doc = docx.Document(path)
   os.makedirs(dest_folder, exist_ok=True)
 
   section = doc.sections[0]
   page_width, page_height,\
     left_margin, right_margin,\
-    top_margin, bottom_margin = map(partial(to_px, dpi=args.dpi),
+    top_margin, bottom_margin = map(partial(to_px, dpi=config.dpi),
                                     (section.page_width,
                                      section.page_height,
                                      section.left_margin,
@@ -373,25 +725,25 @@ def process_doc(args, font_dict):
   page_number = 1
   text_page_height = page_height - top_margin - bottom_margin
   # Iterate over each paragraph in the document
-  img, draw, bboxes = create_page(page_width, page_height, bg)
+  img, draw, bboxes = create_page(page_width, page_height, backgrounds)
   cum_spacing = top_margin
   for i, paragraph in enumerate(doc.paragraphs):
-    if page_number > args.end_page:
+    if page_number > config.end_page:
       break 
     # Extract the text and style of the paragraph
     right_indent, left_indent = get_indents(paragraph)
     style = paragraph.style.name
-    par_spacing = to_px(get_spacing(paragraph), args.dpi)
+    par_spacing = to_px(get_spacing(paragraph, config), config.dpi)
     for j, run in enumerate(paragraph.runs):
       
       if run._element.xpath('w:lastRenderedPageBreak'):
         save(img, bboxes, dest_folder, page_number)
-        img, draw, bboxes = create_page(page_width, page_height)
+        img, draw, bboxes = create_page(page_width, page_height, backgrounds)
         cum_spacing = top_margin
         page_number += 1
-      if page_number > args.end_page:
+      if page_number > config.end_page:
         break
-      font = get_font(run, font_dict)
+      font = get_font(run, font_dict, config)
       text = get_wrapped_text(run.text,
                               font,
                               page_width \
@@ -410,14 +762,14 @@ def process_doc(args, font_dict):
           - font.getlength(line)
         if cum_spacing + font.size > text_page_height:
           save(img, bboxes, dest_folder, page_number)
-          img, draw, bboxes = create_page(page_width, page_height)
+          img, draw, bboxes = create_page(page_width, page_height, backgrounds)
           cum_spacing = top_margin
           page_number += 1
-        if page_number > args.end_page:
+        if page_number > config.end_page:
           break
         y = cum_spacing
         if y > page_height:
-          if args.warn:
+          if config.warn:
             print(f"[WARN] Ran off page at line {line}\n")
           draw.text((x, y), line,
                     font=font,
@@ -431,15 +783,16 @@ def process_doc(args, font_dict):
           cum_spacing += par_spacing
 
 
-def process_doc(args, font_dict):
-  dest_folder = to_project_dir(args.path, args.output_dir)
-  doc = docx.Document(doc_path)
+def process_doc(path, config, font_dict):
+  backgrounds = list_backgrounds(config.background)
+  dest_folder = to_project_dir(path, config.output_dir)
+  doc = docx.Document(path)
   os.makedirs(dest_folder, exist_ok=True)
 
   section = doc.sections[0]
   page_width, page_height,\
     left_margin, right_margin,\
-    top_margin, bottom_margin = map(partial(to_px, dpi=args.dpi),
+    top_margin, bottom_margin = map(partial(to_px, dpi=config.dpi),
                                     (section.page_width,
                                      section.page_height,
                                      section.left_margin,
@@ -450,25 +803,25 @@ def process_doc(args, font_dict):
   page_number = 1
   text_page_height = page_height - top_margin - bottom_margin
   # Iterate over each paragraph in the document
-  img, draw, bboxes = create_page(page_width, page_height, bg)
+  img, draw, bboxes = create_page(page_width, page_height, backgrounds)
   cum_spacing = top_margin
   for i, paragraph in enumerate(doc.paragraphs):
-    if page_number > args.end_page:
+    if page_number > config.end_page:
       break 
     # Extract the text and style of the paragraph
     right_indent, left_indent = get_indents(paragraph)
     style = paragraph.style.name
-    par_spacing = to_px(get_spacing(paragraph), args.dpi)
+    par_spacing = to_px(get_spacing(paragraph, config), config.dpi)
     for j, run in enumerate(paragraph.runs):
       
       if run._element.xpath('w:lastRenderedPageBreak'):
         save(img, bboxes, dest_folder, page_number)
-        img, draw, bboxes = create_page(page_width, page_height)
+        img, draw, bboxes = create_page(page_width, page_height, backgrounds)
         cum_spacing = top_margin
         page_number += 1
-      if page_number > args.end_page:
+      if page_number > config.end_page:
         break
-      font = get_font(run, font_dict)
+      font = get_font(run, font_dict, config)
       text = get_wrapped_text(run.text,
                               font,
                               page_width \
@@ -487,14 +840,14 @@ def process_doc(args, font_dict):
           - font.getlength(line)
         if cum_spacing + font.size > text_page_height:
           save(img, bboxes, dest_folder, page_number)
-          img, draw, bboxes = create_page(page_width, page_height)
+          img, draw, bboxes = create_page(page_width, page_height, backgrounds)
           cum_spacing = top_margin
           page_number += 1
-        if page_number > args.end_page:
+        if page_number > config.end_page:
           break
         y = cum_spacing
         if y > page_height:
-          if args.warn:
+          if config.warn:
             print(f"[WARN] Ran off page at line {line}\n")
           draw.text((x, y), line,
                     font=font,
@@ -507,9 +860,35 @@ def process_doc(args, font_dict):
                          "bbox": bbox})
           cum_spacing += par_spacing
           
+def load_font(config):
+  return truetype(config.font, config.font_px())
+
+def render_file(path, config, output=None, max_lines=None):
+  """Library entry point: render a .txt or .chars file with `config`.
+
+  `config.font` has to be a path to the font file here, names from the
+  `fonts` file are only resolved by `main`. `max_lines` caps the lines of a
+  .txt file rendered, see `process_txt`.
+  """
+  font = load_font(config)
+  if path.endswith('.txt'):
+    return process_txt(path, config, font, output, max_lines)
+  elif path.endswith('.chars'):
+    return process_chars(path, config, font)
+  raise ValueError(f'Cannot render "{path}", expected a .txt or .chars file')
+
+def render_lines(lines, path, config, output=None):
+  "Library entry point like `render_file`, for any iterable of lines named `path`"
+  return process_lines(lines, path, config, load_font(config), output)
+
+def line_crops_from_args(args):
+  if args.dataset != 'lines':
+    return None
+  return LineCrops(args.line_height, args.line_padding, args.line_context)
+
 def main(args):
-  global backgrounds
-  backgrounds = glob.glob(os.path.join(args.background, 'out*.png'))
+  background_cache.configure(args.background_cache_mb, args.background_pool, args.background_pool_mb)
+  word_masks.configure(args.word_cache_mb, args.word_phases)
   if args.alpha:
     args.min_alpha = args.alpha
     args.max_alpha = args.alpha
@@ -519,36 +898,30 @@ def main(args):
     args.right_margin = args.margin
     args.left_margin = args.margin
 
-  DEFAULT.update({"font": args.font,
-                  "font-size": Pt(args.font_size),
-                  "spacing": Inches(args.spacing),
-                  "left-margin": Inches(args.left_margin),
-                  "right-margin": Inches(args.right_margin),
-                  "top-margin": Inches(args.top_margin),
-                  "bottom-margin": Inches(args.bottom_margin),
-                  "page-width": Mm(args.page_width),
-                  "page-height": Mm(args.page_height),
-                  "spacing-rule": line_spacing_map[args.spacing_rule]})
-  
   with open('fonts') as fp:
     font_dict = json.load(fp)
   if args.verbose:
     args.warn = True
   if args.path.endswith(".docx"):
-    process_doc(args, font_dict)
+    process_doc(args.path, RenderConfig.from_args(args), font_dict)
   elif args.path.endswith(".txt") or args.path.endswith('.chars'):
     if os.path.exists(args.font):
       fontpath = args.font
     else:
       fontpath = font_dict[args.font]
     assert os.path.exists(fontpath)
-    font = ImageFont.truetype(fontpath, size=to_px(DEFAULT['font-size'], args.dpi))
-    if args.path.endswith('.txt'):
-      process_txt(args, font)
-    elif args.path.endswith('.chars'):
-      process_chars(args, font)
+    config = RenderConfig.from_args(args)
+    config.font = fontpath
+    writer = make_writer(args.writer_threads, args.writer_queue)
+    with make_output(args.output_format, args.output_dir, writer, args.shard_size_mb,
+                     line_crops_from_args(args)) as output:
+      render_file(args.path, config, output)
+    if args.verbose:
+      print(f'[INFO] Writer: {format_stats(writer.stats())}')
+      if config.compositing == 'words':
+        print(f'[INFO] Word masks: {word_masks.format_stats(word_masks.masks.stats())}')
       
-if __name__ == "__main__":
+def get_parser():
   parser = argparse.ArgumentParser(description="Synthesizer for OCR data")
   parser.add_argument("path", type=str, help="Path to docx or txt file")
   parser.add_argument("--start-page", type=int, help="Starter page to parse",default=0)
@@ -581,12 +954,48 @@ if __name__ == "__main__":
 
   parser.add_argument("--dpi", type=int, default=200, help="Dots per inch")
   
-  parser.add_argument("--background", type=str, help="Path to folder of backgrounds")
+  parser.add_argument("--background", type=str, help="Path to folder of backgrounds, or procedural:<first>-<last> seeds of synthesized ones")
+  parser.add_argument("--background-cache-mb", type=float, default=background_cache.DEFAULT_BUDGET_MB,
+                      help="Memory budget for decoded backgrounds (MiB)")
+  parser.add_argument("--background-pool", type=str, default=None,
+                      help="Folder (e.g. under /dev/shm) to share decoded backgrounds between processes, "
+                           "a raw file per background and page size (about 15 MiB for A4 at 200 DPI)")
+  parser.add_argument("--background-pool-mb", type=float, default=background_cache.DEFAULT_POOL_BUDGET_MB,
+                      help="Size the background pool is kept under, least recently used files are deleted (MiB)")
 
   parser.add_argument("--output-dir", "-o", type=str, help="Path to output directory", default='outputs')
   
+  parser.add_argument("--dataset", choices=['pages', 'lines'], default='pages',
+                      help="Whole pages with bboxes, or every line cropped out with its text")
+  parser.add_argument("--line-height", type=int, default=None,
+                      help="Scale line crops to this height (px)")
+  parser.add_argument("--line-padding", type=int, default=0,
+                      help="White padding around line crops (px)")
+  parser.add_argument("--line-context", type=int, default=0,
+                      help="Surrounding page kept around line crops (px)")
+  parser.add_argument("--output-format", choices=['dir', 'tar'], default='dir',
+                      help="A folder per document, or records appended to rolling tar shards")
+  parser.add_argument("--shard-size-mb", type=float, default=1024,
+                      help="Start a new tar shard once the current one reaches this size (MiB)")
+  parser.add_argument("--writer-threads", type=int, default=1,
+                      help="Threads encoding and writing pages in the background, 0 writes on the render thread")
+  parser.add_argument("--writer-queue", type=int, default=8,
+                      help="Pages that may wait for the writer before rendering blocks")
+
+  parser.add_argument("--compositing", choices=['line', 'page', 'words'], default='line',
+                      help="Blend each line over its own bbox or over the whole page, or assemble it from cached word masks")
+  parser.add_argument("--page-mode", choices=['rgba', 'rgb', 'gray'], default='rgba',
+                      help="Draw on RGBA images, or blend into RGB or grayscale arrays and write those")
+  parser.add_argument("--word-cache-mb", type=float, default=word_masks.DEFAULT_BUDGET_MB,
+                      help="Memory budget for cached word masks (MiB)")
+  parser.add_argument("--word-phases", type=int, default=word_masks.DEFAULT_PHASES,
+                      help="Sub-pixel positions a word mask is cached for")
+
   parser.add_argument("--warn", action="store_true", help="Emit warnings")
   parser.add_argument("--verbose", action="store_true", help="Set warnings and info to true")
   parser.add_argument('--scriptio-continuo', '-sc', action='store_true', help="Replace spaces with zero-width non-joiners")
   
-  main(parser.parse_args())
+  return parser
+
+if __name__ == "__main__":
+  main(get_parser().parse_args())
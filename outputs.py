@@ -0,0 +1,284 @@
+# Where rendered pages go. `process_txt` opens one project per document on an
+# output and hands it every finished page:
+#   DirectoryOutput  outputs/<name>.<timestamp>.d/ with N.png, N.json and
+#                    config.json, removed again if no page was produced
+#   ShardOutput      records appended to rolling tar shards, one record per
+#                    page holding <key>.png, <key>.json and <key>.config.json,
+#                    with a <shard>.index.json listing every record's members
+#                    by offset and size
+# Either can store line crops instead of pages (`LineCrops`): every line of a
+# finished page is cut out of the in-memory page with its text, as
+# N-K.png/N-K.txt in the folder or as one <key>.png/.txt/.config.json record
+# per line in the shards, without encoding the page itself.
+# Encoding and writing go through a writer from writer.py, which the output
+# closes when it is closed itself.
+
+import io
+import json
+import math
+import os
+import shutil
+import socket
+import tarfile
+import threading
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+from writer import SyncWriter
+
+to_project_dir = lambda path, output_dir : os.path.join(output_dir, f"{os.path.basename(path)}.{datetime.now().timestamp()}.d")
+
+def as_image(page):
+  "Pages drawn as uint8 arrays become images only here, on the writer"
+  return Image.fromarray(page) if isinstance(page, np.ndarray) else page
+
+def encode_page(img, bboxes):
+  buffer = io.BytesIO()
+  as_image(img).save(buffer, format='PNG')
+  return buffer.getvalue(), json.dumps(bboxes, ensure_ascii=False)
+
+def write_page(encoded, dest_folder, page_number, verbose=False):
+  png, annotation = encoded
+  img_filename = os.path.join(dest_folder,  f'{page_number}.png')
+  json_filename = os.path.join(dest_folder,  f'{page_number}.json')
+  with open(img_filename, 'wb') as f:
+    f.write(png)
+  with open(json_filename, 'w') as f:
+    f.write(annotation)
+    if verbose:
+      print(f'[INFO] Saved \'{img_filename}\'')
+
+@dataclass
+class LineCrops:
+  """How lines are cut out of a page.
+
+  `context` pixels of the surrounding page are kept around the bbox,
+  `padding` pixels of white are added around that, and with `height` set
+  the crop is scaled to that height keeping its aspect ratio.
+  """
+  height: int = None
+  padding: int = 0
+  context: int = 0
+
+  def crop(self, img, bbox):
+    left, top, right, bottom = bbox
+    box = (max(0, math.floor(left) - self.context),
+           max(0, math.floor(top) - self.context),
+           min(img.width, math.ceil(right) + self.context),
+           min(img.height, math.ceil(bottom) + self.context))
+    if box[2] <= box[0] or box[3] <= box[1]:
+      return None
+    crop = img.crop(box)
+    if crop.mode == 'RGBA':
+      crop = crop.convert('RGB')
+    if self.padding:
+      padded = Image.new(crop.mode,
+                         (crop.width + 2 * self.padding,
+                          crop.height + 2 * self.padding),
+                         color='white')
+      padded.paste(crop, (self.padding, self.padding))
+      crop = padded
+    if self.height:
+      width = max(1, round(crop.width * self.height / crop.height))
+      crop = crop.resize((width, self.height), Image.LANCZOS)
+    return crop
+
+  def encode(self, img, bboxes):
+    "PNG bytes and text of every line on the page that is inside it"
+    img = as_image(img)
+    lines = []
+    for k, entry in enumerate(bboxes):
+      crop = self.crop(img, entry['bbox'])
+      if crop is None:
+        continue
+      buffer = io.BytesIO()
+      crop.save(buffer, format='PNG')
+      lines.append((k, buffer.getvalue(), entry['text']))
+    return lines
+
+def write_lines(lines, dest_folder, page_number, verbose=False):
+  for k, png, text in lines:
+    name = os.path.join(dest_folder, f'{page_number}-{k}')
+    with open(f'{name}.png', 'wb') as f:
+      f.write(png)
+    with open(f'{name}.txt', 'w', encoding='utf-8') as f:
+      f.write(text)
+  if verbose:
+    print(f'[INFO] Saved {len(lines)} lines of page {page_number} to \'{dest_folder}\'')
+
+def document_config(path, config):
+  if config.generator is not None:
+    # synthesized text has no source file, its generator and seed make it again
+    return asdict(config)
+  return {"path": path, **asdict(config)}
+
+class DirectoryOutput:
+  def __init__(self, writer=None, line_crops=None):
+    self.writer = writer if writer is not None else SyncWriter()
+    self.line_crops = line_crops
+
+  def open(self, path, config):
+    return DirectoryProject(self.writer, path, config, self.line_crops)
+
+  def close(self):
+    self.writer.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+class DirectoryProject:
+  def __init__(self, writer, path, config, line_crops=None):
+    self.writer = writer
+    self.path = path
+    self.config = config
+    self.line_crops = line_crops
+    self.dest_folder = to_project_dir(path, config.output_dir)
+    os.makedirs(self.dest_folder, exist_ok=True)
+
+  def save_page(self, img, bboxes, page_number):
+    if self.line_crops is None:
+      encode, write = partial(encode_page, img, bboxes), write_page
+    else:
+      encode, write = partial(self.line_crops.encode, img, bboxes), write_lines
+    self.writer.submit(encode,
+                       partial(write,
+                               dest_folder=self.dest_folder,
+                               page_number=page_number,
+                               verbose=self.config.verbose))
+
+  def close(self, produced):
+    "Returns where the document went, or None if nothing was produced"
+    if not produced:
+      shutil.rmtree(self.dest_folder)
+      return None
+    with open(os.path.join(self.dest_folder, 'config.json'), 'w') as f:
+      json.dump(document_config(self.path, self.config), f)
+    return self.dest_folder
+
+class ShardWriter:
+  """Appends records to `<output_dir>/<prefix>-<seq>.tar`, starting a new
+  shard once the current one reaches `shard_size_mb`.
+
+  A shard is written as `.tar.tmp` and renamed when it is closed, so any
+  `.tar` in the folder is complete. Its index lists the records in order,
+  each as {"key": ..., "members": {extension: [offset, size]}}.
+  """
+  def __init__(self, output_dir, shard_size_mb=1024, prefix=None):
+    self.output_dir = output_dir
+    self.shard_size = int(shard_size_mb * 2 ** 20)
+    self.prefix = prefix if prefix is not None \
+      else f'shard-{socket.gethostname()}-{os.getpid()}-{int(time.time())}'
+    self.lock = threading.Lock()
+    self.seq = 0
+    self.tar = None
+    self.tar_path = None
+    self.index = []
+    os.makedirs(output_dir, exist_ok=True)
+
+  def add(self, key, members):
+    "Append one record; `members` maps extensions to bytes"
+    with self.lock:
+      if self.tar is None:
+        self.tar_path = os.path.join(self.output_dir, f'{self.prefix}-{self.seq:06d}.tar')
+        self.tar = tarfile.open(f'{self.tar_path}.tmp', 'w')
+        self.index = []
+        self.seq += 1
+      record = {'key': key, 'members': {}}
+      for extension, data in members.items():
+        info = tarfile.TarInfo(f'{key}.{extension}')
+        info.size = len(data)
+        info.mtime = int(time.time())
+        header = info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors)
+        record['members'][extension] = [self.tar.offset + len(header), len(data)]
+        self.tar.addfile(info, io.BytesIO(data))
+      self.index.append(record)
+      if self.tar.offset >= self.shard_size:
+        self.roll()
+
+  def roll(self):
+    if self.tar is None:
+      return
+    self.tar.close()
+    os.replace(f'{self.tar_path}.tmp', self.tar_path)
+    with open(f'{self.tar_path}.index.json', 'w') as f:
+      json.dump(self.index, f, ensure_ascii=False)
+    self.tar = None
+
+  def close(self):
+    with self.lock:
+      self.roll()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+class ShardOutput:
+  def __init__(self, shards, writer=None, line_crops=None):
+    self.shards = shards
+    self.writer = writer if writer is not None else SyncWriter()
+    self.line_crops = line_crops
+
+  def open(self, path, config):
+    return ShardProject(self, path, config)
+
+  def close(self):
+    # drain the writer first, it may still be appending records
+    self.writer.close()
+    self.shards.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+class ShardProject:
+  def __init__(self, output, path, config):
+    self.output = output
+    self.config = config
+    # keys must not contain dots, readers like webdataset split on them
+    name = os.path.basename(path).replace('.', '_')
+    self.key = f'{name}_{int(datetime.now().timestamp() * 1e6)}'
+    self.config_json = json.dumps(document_config(path, config)).encode()
+
+  def encode(self, img, bboxes):
+    png, annotation = encode_page(img, bboxes)
+    return {'png': png,
+            'json': annotation.encode(),
+            'config.json': self.config_json}
+
+  def encode_lines(self, img, bboxes):
+    return [(k, {'png': png,
+                 'txt': text.encode(),
+                 'config.json': self.config_json})
+            for k, png, text in self.output.line_crops.encode(img, bboxes)]
+
+  def add_lines(self, lines, page_number):
+    for k, members in lines:
+      self.output.shards.add(f'{self.key}_{page_number:05d}_{k:03d}', members)
+
+  def save_page(self, img, bboxes, page_number):
+    if self.output.line_crops is None:
+      self.output.writer.submit(partial(self.encode, img, bboxes),
+                                partial(self.output.shards.add, f'{self.key}_{page_number:05d}'))
+    else:
+      self.output.writer.submit(partial(self.encode_lines, img, bboxes),
+                                partial(self.add_lines, page_number=page_number))
+
+  def close(self, produced):
+    return self.output.shards.output_dir if produced else None
+
+def make_output(output_format, output_dir, writer=None, shard_size_mb=1024, line_crops=None):
+  if output_format == 'tar':
+    return ShardOutput(ShardWriter(output_dir, shard_size_mb), writer, line_crops)
+  return DirectoryOutput(writer, line_crops)
@@ -1,7 +1,21 @@
 #!/usr/bin/env python
-import re
+
+# Cleans scraped sources into sources/scraped-preprocessed/. Files are spread
+# over a pool of processes, each streaming its file in chunks of lines, and a
+# manifest in the output folder records the source hash and rule set every
+# output was made with, so a rerun only processes new or changed sources.
+
+import argparse
 import glob
+import hashlib
+import json
 import os
+import re
+import shutil
+import time
+from multiprocessing import Pool, cpu_count
+
+from tqdm import tqdm
 
 replacements = [
   (r"[^\u0600-\u06ff\u0750-\u077f\uFE70-\uFEFF\uFB50-\uFDFF\u0870-\u089F\W\n]+\b", ''),
@@ -37,26 +51,168 @@ replacements = [
   (r'\n[،۔«»﴾﴿ ]+\n', ''),
 ]
 
+ARABIC = r'\u0600-\u06ff\u0750-\u077f\uFE70-\uFEFF\uFB50-\uFDFF\u0870-\u089F'
+compiled_replacements = [(re.compile(pattern), rep) for pattern, rep in replacements]
+non_arabic = re.compile(f'[^{ARABIC}]')
+arabic = re.compile(f'[{ARABIC}]')
+
+# outputs made by other rules are redone
+RULES_HASH = hashlib.sha1(repr((ARABIC, replacements)).encode()).hexdigest()
+
+MANIFEST = '.manifest.json'
+
+def keep_line(line):
+  line_count = len(line)
+  # latin_count = len(re.sub(r'[^a-zA-z]', '', line))
+  arab_count = len(non_arabic.sub('', line))
+  return not (line_count > 0 and (arab_count / line_count) > 0.9)
+
 def preprocess_text(text):
-  lines = []
-  for line in text.split('\n'):
-    line_count = len(line)
-    # latin_count = len(re.sub(r'[^a-zA-z]', '', line))
-    arab_count = len(re.sub(r'[^\u0600-\u06ff\u0750-\u077f\uFE70-\uFEFF\uFB50-\uFDFF\u0870-\u089F]', '', line))
-    if line_count > 0 and (arab_count / line_count) > 0.9:
-      continue
-    else:
-      lines.append(line)
-  text = '\n'.join(lines)
-  for pattern, rep in replacements:
-    text = re.sub(pattern, rep, text)
+  text = '\n'.join(line for line in text.split('\n') if keep_line(line))
+  for pattern, rep in compiled_replacements:
+    text = pattern.sub(rep, text)
   return text
 
+def seam_char(ch):
+  "Arabic letters and digits are never changed or matched over by a rule"
+  return ch.isalnum() and ch not in '\u0621\u0674' and arabic.match(ch) is not None
+
+def is_seam(line, next_line):
+  """Whether the text can be cut between these consecutive lines, with both
+  sides preprocessed on their own.
+
+  The rules that join or drop lines all need spaces, punctuation, harakat
+  or another newline next to a newline, so none reaches over one between
+  two letters of lines that are kept.
+  """
+  return (line != '' and next_line != ''
+          and seam_char(line[-1]) and seam_char(next_line[0])
+          and keep_line(line) and keep_line(next_line))
+
+def read_chunks(path, chunk_lines):
+  """The text of `path` in pieces of at least `chunk_lines` lines, cut at
+  seams so that preprocessing every piece gives the same text as
+  preprocessing the whole file. Without a seam a piece grows until the
+  next one."""
+  lines = []
+  line = ''
+  with open(path, encoding='utf-8') as f:
+    for line in f:
+      text = line[:-1] if line.endswith('\n') else line
+      if len(lines) >= chunk_lines and is_seam(lines[-1], text):
+        yield '\n'.join(lines) + '\n'
+        lines = []
+      lines.append(text)
+  # text.split('\n') ends with an empty line after a final newline
+  if line.endswith('\n'):
+    lines.append('')
+  yield '\n'.join(lines)
+
+def metadata_path(path):
+  return f'{path[:-len(".txt")]}.metadata.json'
+
+def source_stat(path):
+  "What a source is assumed unchanged by, together with its metadata"
+  stat = os.stat(path)
+  try:
+    metadata = os.stat(metadata_path(path))
+    return [stat.st_size, stat.st_mtime_ns, metadata.st_size, metadata.st_mtime_ns]
+  except FileNotFoundError:
+    return [stat.st_size, stat.st_mtime_ns, None, None]
+
+def source_hash(path):
+  digest = hashlib.sha1()
+  for name in (path, metadata_path(path)):
+    if os.path.exists(name):
+      with open(name, 'rb') as f:
+        while block := f.read(2 ** 20):
+          digest.update(block)
+  return digest.hexdigest()
+
+def atomic_copy(src, dst):
+  tmp = f'{dst}.{os.getpid()}.tmp'
+  shutil.copyfile(src, tmp)
+  os.replace(tmp, dst)
+
+def preprocess_file(job):
+  """Preprocess one source into `dst`, unless the manifest `entry` shows it
+  was made from the same content with the same rules.
+
+  Returns the source's new manifest entry and the bytes preprocessed, None
+  if it was left as it was.
+  """
+  name, src, dst, entry, chunk_lines = job
+  # taken before hashing, a later change is seen by the next run
+  stat = source_stat(src)
+  new_entry = {"source": source_hash(src), "stat": stat, "rules": RULES_HASH}
+  if entry is not None and os.path.exists(dst) \
+     and (entry["source"], entry["rules"]) == (new_entry["source"], RULES_HASH):
+    return name, new_entry, None
+  os.makedirs(os.path.dirname(dst), exist_ok=True)
+  tmp = f'{dst}.{os.getpid()}.tmp'
+  with open(tmp, 'w', encoding='utf-8') as f:
+    for chunk in read_chunks(src, chunk_lines):
+      f.write(preprocess_text(chunk))
+  os.replace(tmp, dst)
+  if os.path.exists(metadata_path(src)):
+    atomic_copy(metadata_path(src), metadata_path(dst))
+  return name, new_entry, stat[0]
+
+def load_manifest(output_dir):
+  try:
+    with open(os.path.join(output_dir, MANIFEST), encoding='utf-8') as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return {}
+
+def save_manifest(output_dir, manifest):
+  path = os.path.join(output_dir, MANIFEST)
+  with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+    json.dump(manifest, f, ensure_ascii=False)
+  os.replace(f'{path}.tmp', path)
+
 if __name__ == '__main__':
-  for d in glob.glob('sources/scraped/**/*.txt', recursive=True):
-    d_new = d.replace('scraped', 'scraped-preprocessed')
-    os.makedirs(os.path.dirname(d_new), exist_ok=True)
-    with open(d_new, 'w') as f:
-      f.write(preprocess_text(open(d).read()))
-    with open(d_new.replace('.txt', '.metadata.json'), 'w') as f:
-      f.write(open(d.replace('.txt', '.metadata.json')).read())
+  parser = argparse.ArgumentParser(description="Preprocess scraped sources, skipping those already done with the same rules")
+  parser.add_argument('path', type=str, nargs='?', default='sources/scraped', help='Path to scraped sources')
+  parser.add_argument("--output-dir", "-o", type=str, default='sources/scraped-preprocessed',
+                      help="Path to output directory")
+  parser.add_argument('--chunk-lines', type=int, default=100000,
+                      help='Lines of a source preprocessed at a time')
+  parser.add_argument('--force', action='store_true', help='Redo every source')
+  parser.add_argument('--batch-size', '-b', type=int, default=cpu_count(),
+                      help='Number of worker processes')
+  args = parser.parse_args()
+
+  os.makedirs(args.output_dir, exist_ok=True)
+  manifest = {} if args.force else load_manifest(args.output_dir)
+  jobs = []
+  unchanged = 0
+  for src in sorted(glob.glob(os.path.join(args.path, '**/*.txt'), recursive=True)):
+    name = os.path.relpath(src, args.path)
+    dst = os.path.join(args.output_dir, name)
+    entry = manifest.get(name)
+    if entry is not None and entry["rules"] == RULES_HASH and entry["stat"] == source_stat(src) \
+       and os.path.exists(dst):
+      unchanged += 1
+      continue
+    jobs.append((name, src, dst, entry, args.chunk_lines))
+
+  start = time.perf_counter()
+  done = 0
+  processed_bytes = 0
+  with Pool(processes=min(args.batch_size, cpu_count())) as pool:
+    try:
+      results = pool.imap_unordered(preprocess_file, jobs)
+      for i, (name, entry, size) in enumerate(tqdm(results, total=len(jobs), leave=False)):
+        manifest[name] = entry
+        if size is not None:
+          done += 1
+          processed_bytes += size
+        if i % 100 == 99:
+          save_manifest(args.output_dir, manifest)
+    finally:
+      # whatever finished is not redone by the next run
+      save_manifest(args.output_dir, manifest)
+  elapsed = max(time.perf_counter() - start, 1e-9)
+  print(f'{done} sources preprocessed, {unchanged + len(jobs) - done} unchanged, '
+        f'{processed_bytes / 2 ** 20:.1f} MiB in {elapsed:.1f}s ({processed_bytes / 2 ** 20 / elapsed:.2f} MiB/s)')
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# Paper textures synthesized with NumPy, as a CPU-friendly stand-in for the
+# texture-synthesis backgrounds of background_generation.py. A texture is
+# named by an ID, procedural:<seed>, and rendered directly at the page size
+# it is asked for: multi-octave noise for the uneven tone of the paper,
+# grain and fibres, stains with darker rims, fold lines, vignetting and the
+# show-through of text on the back of the sheet.
+#
+# Rendered textures are kept under .cache/procedural-backgrounds/, addressed
+# by a hash of everything they are made from (the generator version, the
+# seed and the size), so any worker can ask for a background ID and only the
+# first one to do so pays for the synthesis.
+
+import argparse
+import hashlib
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+# part of every texture's address, bump when the synthesis changes
+VERSION = 1
+PREFIX = 'procedural:'
+CACHE_DIR = os.path.join('.cache', 'procedural-backgrounds')
+
+def is_procedural(background):
+  return background.startswith(PREFIX)
+
+def expand(spec):
+  """Background IDs of `spec`, either one ID (procedural:<seed>) or a range
+  of seeds (procedural:<first>-<last>)"""
+  seeds = spec[len(PREFIX):]
+  first, _, last = seeds.partition('-')
+  return [f'{PREFIX}{seed}' for seed in range(int(first), int(last or first) + 1)]
+
+def upsample(noise, width, height):
+  return np.asarray(Image.fromarray(noise.astype(np.float32)).resize((width, height), Image.BICUBIC))
+
+def fbm(rng, width, height, octaves=6, persistence=0.55, cells=3):
+  "Value noise summed over `octaves` doubling frequencies, about [-0.5, 0.5]"
+  total = np.zeros((height, width), np.float32)
+  amplitude = norm = 1.
+  scale = cells / max(width, height)
+  for _ in range(octaves):
+    grid = rng.random((max(2, round(height * scale)), max(2, round(width * scale))))
+    total += amplitude * upsample(grid, width, height)
+    norm += amplitude
+    amplitude *= persistence
+    scale *= 2
+  return (total - total.mean()) / (norm - 1.) * 1.6
+
+def stains(rng, field, count):
+  "Darkening of `count` stains with ragged edges and darker rims"
+  height, width = field.shape
+  shade = np.zeros_like(field)
+  for _ in range(count):
+    radius = rng.uniform(0.03, 0.18) * min(width, height)
+    cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+    strength = rng.uniform(0.03, 0.12)
+    x0, x1 = max(0, int(cx - 1.5 * radius)), min(width, int(cx + 1.5 * radius) + 1)
+    y0, y1 = max(0, int(cy - 1.5 * radius)), min(height, int(cy + 1.5 * radius) + 1)
+    if x1 <= x0 or y1 <= y0:
+      continue
+    yy, xx = np.ogrid[y0:y1, x0:x1]
+    distance = np.hypot(xx - cx, yy - cy) / radius * (1 + 0.6 * field[y0:y1, x0:x1])
+    inside = np.clip((1 - distance) * 3, 0, 1)
+    rim = np.exp(-((distance - 1) / 0.05) ** 2)
+    shade[y0:y1, x0:x1] += strength * (0.7 * inside + rim)
+  return shade
+
+def folds(rng, width, height, count):
+  "Brightness change along `count` creases across the sheet"
+  shade = np.zeros((height, width), np.float32)
+  for _ in range(count):
+    vertical = rng.random() < 0.5
+    length = width if vertical else height
+    position = rng.uniform(0.25, 0.75) * length
+    d = np.arange(length, dtype=np.float32) - position
+    # a thin dark crease, one side of it lit and the other in shadow
+    profile = -rng.uniform(0.03, 0.1) * np.exp(-(d / rng.uniform(1., 3.)) ** 2) \
+      + rng.uniform(0.005, 0.02) * np.tanh(d / rng.uniform(10, 60))
+    shade += profile[None, :] if vertical else profile[:, None]
+  return shade
+
+def vignette(rng, width, height):
+  x = np.linspace(-1, 1, width, dtype=np.float32) ** 2
+  y = np.linspace(-1, 1, height, dtype=np.float32) ** 2
+  return -rng.uniform(0.03, 0.2) * ((x[None, :] + y[:, None]) / 2) ** 1.5
+
+def show_through(rng, width, height, scale=4):
+  "Blurred, mirrored lines of text from the back of the sheet"
+  low = np.zeros((max(1, height // scale), max(1, width // scale)), np.float32)
+  pitch = rng.uniform(0.02, 0.035) * height / scale
+  x_height = max(1, round(pitch * 0.35))
+  margin = rng.uniform(0.06, 0.12)
+  left, right = int(margin * low.shape[1]), int((1 - margin) * low.shape[1])
+  y = margin * low.shape[0]
+  while y + x_height < (1 - margin) * low.shape[0]:
+    x = left
+    while x < right:
+      word = rng.uniform(0.02, 0.08) * low.shape[1]
+      low[int(y):int(y) + x_height, int(x):int(min(x + word, right))] = 1
+      x += word + rng.uniform(0.008, 0.015) * low.shape[1]
+    y += pitch
+  ink = upsample(low[:, ::-1], width, height)
+  return -rng.uniform(0.01, 0.04) * np.clip(ink, 0, 1)
+
+def synthesize(seed, width, height):
+  "RGB texture number `seed` at `width`x`height`, as a uint8 array"
+  rng = np.random.default_rng([VERSION, seed])
+  red = rng.uniform(228, 250)
+  green = red - rng.uniform(3, 18)
+  paper = np.array([red, green, green - rng.uniform(5, 30)], np.float32)
+  # parchment or fairly white paper
+  if rng.random() < 0.3:
+    paper = 250 - (250 - paper) * 0.3
+  tone = fbm(rng, width, height)
+  light = 1 + rng.uniform(0.04, 0.12) * tone
+  light += rng.uniform(0.01, 0.03) * rng.standard_normal((height, width), dtype=np.float32)
+  fibres = rng.standard_normal((height, max(2, width // 8)), dtype=np.float32)
+  light += rng.uniform(0.005, 0.02) * upsample(fibres, width, height)
+  light += folds(rng, width, height, rng.choice(3, p=(0.5, 0.35, 0.15)))
+  light += vignette(rng, width, height)
+  if rng.random() < 0.6:
+    light += show_through(rng, width, height)
+  stained = stains(rng, fbm(rng, width, height, octaves=4, cells=8), rng.poisson(1.5))
+  # stains brown the paper, taking more blue than red
+  tint = 1 - stained[..., None] * np.array([0.5, 0.75, 1.], np.float32)
+  rgb = paper * light[..., None] * tint
+  return np.clip(rgb, 0, 255).astype(np.uint8)
+
+def texture_path(background, width, height, cache_dir=CACHE_DIR):
+  "Path of the PNG of `background` at `width`x`height`, synthesized on first use"
+  seed = int(background[len(PREFIX):])
+  key = hashlib.sha1(f'{VERSION}:{seed}:{width}x{height}'.encode()).hexdigest()
+  path = os.path.join(cache_dir, f'{key}.png')
+  if not os.path.exists(path):
+    os.makedirs(cache_dir, exist_ok=True)
+    # workers asking for the same texture race to the rename, and each
+    # rename leaves a complete file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    # fast compression, the cache is read far more often than written
+    Image.fromarray(synthesize(seed, width, height)).save(tmp_path, format='PNG', compress_level=1)
+    os.replace(tmp_path, path)
+  return path
+
+def load(background, width, height, cache_dir=CACHE_DIR):
+  return Image.open(texture_path(background, width, height, cache_dir))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Synthesize paper backgrounds into the texture cache")
+  parser.add_argument('spec', type=str, nargs='?', default='procedural:0-15',
+                      help='procedural:<seed> or procedural:<first>-<last>')
+  parser.add_argument('--size', type=int, nargs=2, default=[1654, 2339], metavar=('WIDTH', 'HEIGHT'),
+                      help='Texture size (px), A4 at 200 DPI by default')
+  parser.add_argument('--cache-dir', type=str, default=CACHE_DIR, help='Where to keep the textures')
+  parser.add_argument('--dry-run', action='store_true', help='Only synthesize, to time it without writing')
+  args = parser.parse_args()
+  backgrounds = expand(args.spec)
+  width, height = args.size
+  start = time.perf_counter()
+  for background in backgrounds:
+    if args.dry_run:
+      synthesize(int(background[len(PREFIX):]), width, height)
+    else:
+      texture_path(background, width, height, args.cache_dir)
+  elapsed = time.perf_counter() - start
+  print(f'{len(backgrounds)} textures of {width}x{height} in {elapsed:.1f}s '
+        f'({len(backgrounds) / elapsed:.2f} textures/s)'
+        + ('' if args.dry_run else f' under \'{args.cache_dir}\''))
@@ -1,66 +1,148 @@
 #!/usr/bin/env python
 
+import math
 import os
 import random
 import glob
 import sys
-import signal
 import argparse
+import dataclasses
+import itertools
+import signal
+import traceback
 import docx
-from tqdm import trange
-from multiprocessing import Pool, cpu_count
-import subprocess
+from tqdm import tqdm
+from multiprocessing import Pool, Event, cpu_count
+from multiprocessing.util import Finalize
+
+from main import RenderConfig, render_file, render_lines, process_variants, line_crops_from_args
+import font_cache
+import background_cache
+import procedural_backgrounds
+import word_masks
+from glyph_coverage import build_index, find_fonts
+from corpus_index import CorpusIndex
+from font_compatibility import CompatibilityMatrix, count_lines_covered
+from synthetic_source import SyntheticSource, GENERATORS
+from writer import make_writer, format_stats as format_writer_stats
+from outputs import make_output
 
 font_sizes = range(17, 30)
 
-def generate_command(path, output_dir, bg_path, fonts,
-                     min_spacing, max_spacing, min_dpi, max_dpi,
-                     warn, verbose):
-  
-  if path.endswith('.txt') or path.endswith('.chars'):
-    docs = [path]
-  elif os.path.isdir(path):
-    docs = glob.glob(os.path.join(path, '**/*.txt'), recursive=True)
-  backgrounds = glob.glob(os.path.join(bg_path, '*'))
-  fonts = glob.glob(os.path.join(fonts, '**/*.ttf'), recursive=True)
-  
-  font_size = random.choice(font_sizes)
-  spacing = random.uniform(min_spacing, max_spacing) * docx.shared.Pt(font_size).inches
-  try:
+def generate_job(docs, backgrounds, fonts, output_dir,
+                 min_spacing, max_spacing, min_dpi, max_dpi,
+                 warn, verbose, sample='window', window_lines=0,
+                 variants=1, layouts=None, compositing='line', page_mode='rgba',
+                 compatible=None):
+  """A random document and the RenderConfigs to render it with.
+
+  `docs` is a CorpusIndex, or a list of files rendered whole. With
+  `sample='window'` rendering starts at a random line of a document picked
+  by size, otherwise a whole document is picked uniformly. A
+  SyntheticSource makes every job render its own newly generated text.
+
+  The `variants` configs share the text, spacing relative to the font size,
+  margins and scriptio continuo. They are spread over `layouts` sampled
+  (font, size, DPI) settings, which process_variants lays out once each,
+  and each samples its own background and alpha.
+
+  `compatible` maps documents to the fonts they may be rendered with,
+  otherwise any font is.
+  """
+  start_offset = 0
+  end_page = math.inf
+  if isinstance(docs, SyntheticSource):
+    doc = dataclasses.replace(docs, seed=random.getrandbits(64))
+    end_page = docs.pages
+  elif isinstance(docs, CorpusIndex):
+    if sample == 'window':
+      doc, start_offset = docs.sample(window_lines)
+    else:
+      doc = random.choice(docs.paths)
+  else:
     doc = random.choice(docs)
-  except IndexError as e:
-    e.add_note(f'Empty document set from path {path}')
-    raise
-  try:
-    background = random.choice(backgrounds)
-  except IndexError as e:
-    e.add_note(f'Empty background set from path {bg_path}')
-    raise
-  try:
-    font = random.choice(fonts)
-  except IndexError as e:
-    e.add_note(f'Empty fonts set from path {fonts}')
-    raise
-  min_alpha = random.uniform(0.5, 0.8)
+  if compatible is not None:
+    fonts = compatible[doc]
+  spacing = random.uniform(min_spacing, max_spacing)
   margin = random.uniform(0.6, 0.8)
-  dpi = random.randint(min_dpi, max_dpi)
   scriptio_continuo = random.random() > 0.7
-  cmd = f"./main.py \"{doc}\" --font-size {font_size} --background \"{background}\" --font \"{font}\" --spacing {spacing} --min-alpha {min_alpha} --margin {margin} --output-dir \"{output_dir}\" {'--warn' if warn else ''} {'--verbose' if verbose else ''} --dpi {dpi} {'-sc' if scriptio_continuo else ''}"
-  return cmd
+  settings = [(random.choice(fonts), random.choice(font_sizes), random.randint(min_dpi, max_dpi))
+              for _ in range(layouts or variants)]
+  source_fields = doc.config_fields() if isinstance(doc, SyntheticSource) else {}
+  configs = []
+  for i in range(variants):
+    font, font_size, dpi = settings[i % len(settings)]
+    configs.append(RenderConfig(font=font, font_size=font_size,
+                                background=random.choice(backgrounds),
+                                spacing=spacing * docx.shared.Pt(font_size).inches,
+                                min_alpha=random.uniform(0.5, 0.8),
+                                left_margin=margin, right_margin=margin,
+                                top_margin=margin, bottom_margin=margin,
+                                output_dir=output_dir, warn=warn, verbose=verbose,
+                                dpi=dpi, scriptio_continuo=scriptio_continuo,
+                                start_offset=start_offset, end_page=end_page, compositing=compositing,
+                                page_mode=page_mode, **source_fields))
+  if isinstance(doc, SyntheticSource):
+    return doc, configs, doc.max_lines
+  # the window is rendered from a sampled start whether or not there are
+  # variants, a whole document from its start otherwise
+  return doc, configs, (window_lines or None) if sample == 'window' else None
 
-def run_command(command):
-  try:
-    subprocess.run(command, shell=True, check=True)
-  except subprocess.CalledProcessError as e:
-    if e.returncode == signal.SIGINT:
-      print("Received KeyboardInterrupt. Stopping the program.")
-      os.kill(os.getpid(), signal.SIGINT)  # Stop the program entirely
+page_writer = None
+page_output = None
+stop_event = None
+
+def init_worker(args, stop):
+  global page_writer, page_output, stop_event
+  # forked workers would otherwise share the parent's random state
+  random.seed()
+  # Ctrl-C is handled by the parent, which lets the workers drain
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  stop_event = stop
+  background_cache.configure(args.background_cache_mb, args.background_pool, args.background_pool_mb)
+  word_masks.configure(args.word_cache_mb, args.word_phases)
+  page_writer = make_writer(args.writer_threads, args.writer_queue)
+  page_output = make_output(args.output_format, args.output_dir, page_writer, args.shard_size_mb,
+                            line_crops_from_args(args))
+  # run when the worker exits normally, i.e. on pool.close() and join(),
+  # flushing the writer and closing the worker's current shard
+  Finalize(page_output, page_output.close, exitpriority=10)
+
+def worker_stats():
+  return {'font cache': font_cache.format_stats(font_cache.cache_stats()),
+          'background cache': background_cache.format_stats(background_cache.backgrounds.stats()),
+          'word masks': word_masks.format_stats(word_masks.masks.stats()),
+          'writer': format_writer_stats(page_writer.stats())}
+
+def run_job(job):
+  # runs inside a long-lived worker, so a failing job only costs itself
+  path, configs, max_lines = job
+  if not stop_event.is_set():
+    try:
+      if isinstance(path, SyntheticSource):
+        # generated only as far as the pages need it
+        with path.open() as stream:
+          lines = itertools.islice(stream, max_lines)
+          if len(configs) == 1:
+            render_lines(lines, path.name, configs[0], page_output)
+          else:
+            process_variants(path.name, configs, page_output, lines=lines)
+      elif len(configs) == 1:
+        render_file(path, configs[0], page_output, max_lines)
+      else:
+        process_variants(path, configs, page_output, max_lines)
+    except Exception:
+      fonts = ', '.join(sorted({config.font for config in configs}))
+      print(f'[WARN] Job on "{path}" with fonts "{fonts}" failed:', file=sys.stderr)
+      traceback.print_exc()
+  return os.getpid(), worker_stats()
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description="Random generator")
-  parser.add_argument('path', type=str, help='Path to docs')
+  parser.add_argument('path', type=str,
+                      help=f'Path to docs, or synthesized:<generator> ({", ".join(sorted(GENERATORS))}) to render newly generated text')
   parser.add_argument('iters', type=int, help='Number of docs to generate')
-  parser.add_argument('--bg-path', type=str, help='Path to bg',
+  parser.add_argument('--bg-path', type=str, help='Path to bg, or procedural:<first>-<last> seeds of synthesized ones',
                       default='Backgrounds')
   parser.add_argument('--fonts', type=str, help='Path to fonts',
                       default='fonts.d')
@@ -77,13 +159,132 @@ if __name__ == '__main__':
   parser.add_argument('--min-dpi', type=int, default=72)
   parser.add_argument('--max-dpi', type=int, default=250)
 
-  parser.add_argument('--batch-size', '-b', type=int, default=1)
+  parser.add_argument('--sample', choices=['window', 'document'], default='window',
+                      help='Start at a random line of a document picked by size, or render a random document from its start')
+  parser.add_argument('--window-lines', type=int, default=200,
+                      help='Lines rendered from a sampled start, which is picked to leave that many before the end '
+                           'of its document (0: render to the end)')
+  parser.add_argument('--variants', type=int, default=1,
+                      help='Documents rendered from the same text per job, each with its own background and alpha')
+  parser.add_argument('--variant-layouts', type=int, default=None,
+                      help='Distinct (font, size, DPI) settings among the variants of a job (default: one per variant)')
+
+  parser.add_argument('--synthetic-pages', type=int, default=4,
+                      help='Pages rendered from each synthesized document')
+  parser.add_argument('--synthetic-chunk-words', type=int, default=2000,
+                      help='Words synthesized at a time')
+  parser.add_argument('--synthetic-queue', type=int, default=4,
+                      help='Synthesized chunks that may wait for the renderer')
+
+  parser.add_argument('--min-coverage', type=float, default=0.9,
+                      help='Share of a document\'s lines a font must have every character of to be paired with it, 0 pairs any')
+
+  parser.add_argument('--compositing', choices=['line', 'page', 'words'], default='line',
+                      help='Blend each line over its own bbox or over the whole page, or assemble it from cached word masks')
+  parser.add_argument('--page-mode', choices=['rgba', 'rgb', 'gray'], default='rgba',
+                      help='Draw on RGBA images, or blend into RGB or grayscale arrays and write those')
+  parser.add_argument('--word-cache-mb', type=float, default=word_masks.DEFAULT_BUDGET_MB,
+                      help='Memory budget for cached word masks per worker (MiB)')
+  parser.add_argument('--word-phases', type=int, default=word_masks.DEFAULT_PHASES,
+                      help='Sub-pixel positions a word mask is cached for')
+
+  parser.add_argument('--background-cache-mb', type=float, default=background_cache.DEFAULT_BUDGET_MB,
+                      help='Memory budget for decoded backgrounds per worker (MiB)')
+  parser.add_argument('--background-pool', type=str, default=None,
+                      help='Folder (e.g. under /dev/shm) where workers share decoded backgrounds, a raw file per '
+                           'background and page size (about 15 MiB for A4 at 200 DPI, every sampled DPI gets its own)')
+  parser.add_argument('--background-pool-mb', type=float, default=background_cache.DEFAULT_POOL_BUDGET_MB,
+                      help='Size the background pool is kept under, least recently used files are deleted (MiB)')
+
+  parser.add_argument('--dataset', choices=['pages', 'lines'], default='pages',
+                      help='Whole pages with bboxes, or every line cropped out with its text')
+  parser.add_argument('--line-height', type=int, default=None,
+                      help='Scale line crops to this height (px)')
+  parser.add_argument('--line-padding', type=int, default=0,
+                      help='White padding around line crops (px)')
+  parser.add_argument('--line-context', type=int, default=0,
+                      help='Surrounding page kept around line crops (px)')
+  parser.add_argument('--output-format', choices=['dir', 'tar'], default='dir',
+                      help='A folder per document, or records appended to rolling tar shards per worker')
+  parser.add_argument('--shard-size-mb', type=float, default=1024,
+                      help='Start a new tar shard once the current one reaches this size (MiB)')
+  parser.add_argument('--writer-threads', type=int, default=1,
+                      help='Threads per worker encoding and writing pages, 0 writes on the render thread')
+  parser.add_argument('--writer-queue', type=int, default=8,
+                      help='Pages per worker that may wait for the writer before rendering blocks')
+
+  parser.add_argument('--batch-size', '-b', type=int, default=1,
+                      help='Number of worker processes rendering in parallel')
+  parser.add_argument('--max-jobs-per-worker', type=int, default=None,
+                      help='Restart a worker after this many jobs (default: never)')
   
   args = parser.parse_args()
-  for it in trange(0, args.iters, args.batch_size, leave=False):
-    commands = [generate_command(args.path, args.output_dir, args.bg_path, args.fonts,
-                                 args.min_spacing, args.max_spacing, args.min_dpi, args.max_dpi,
-                                 args.warn, args.verbose) for com in range(min(args.iters-it, args.batch_size))]
-    with Pool(processes=min(args.batch_size, cpu_count())) as pool:
-      pool.map(run_command, commands)
-
+  # filled before forking, so every worker checks lines against the same
+  # in-memory coverage sets and the on-disk index is written only once
+  build_index(args.fonts)
+  # listed once here instead of globbed again for every job
+  if args.path.startswith('synthesized:'):
+    generator = args.path[len('synthesized:'):]
+    if generator not in GENERATORS:
+      sys.exit(f'Unknown generator {generator}, expected one of {", ".join(sorted(GENERATORS))}')
+    docs = SyntheticSource(generator, args.synthetic_pages,
+                           chunk_words=args.synthetic_chunk_words, max_queue=args.synthetic_queue)
+  elif args.path.endswith('.chars'):
+    docs = [args.path]
+  else:
+    docs = CorpusIndex(args.path).refresh()
+    if not docs:
+      sys.exit(f'Empty document set from path {args.path}')
+    if args.verbose:
+      print(f'[INFO] Corpus: {docs.stats()}')
+  if procedural_backgrounds.is_procedural(args.bg_path):
+    backgrounds = procedural_backgrounds.expand(args.bg_path)
+  else:
+    backgrounds = glob.glob(os.path.join(args.bg_path, '*'))
+  if not backgrounds:
+    sys.exit(f'Empty background set from path {args.bg_path}')
+  fonts = find_fonts(args.fonts)
+  if not fonts:
+    sys.exit(f'Empty fonts set from path {args.fonts}')
+  compatible = None
+  if args.min_coverage > 0 and isinstance(docs, SyntheticSource):
+    # checked on a sample, the generated text differs from job to job
+    lines, covered = count_lines_covered(docs.sample(), fonts)
+    fonts = [font for font in fonts if lines and covered[font] / lines >= args.min_coverage]
+    if not fonts:
+      sys.exit(f'No font in {args.fonts} covers {args.min_coverage:.0%} of the lines of {args.path}')
+  elif args.min_coverage > 0 and isinstance(docs, CorpusIndex):
+    # jobs only pair documents with fonts that render most of their lines
+    matrix = CompatibilityMatrix(fonts).refresh(docs.paths, min(args.batch_size, cpu_count()))
+    compatible = {doc: matrix.fonts_for(doc, args.min_coverage) for doc in docs.paths}
+    if args.verbose:
+      print(f'[INFO] Font compatibility: {matrix.stats(args.min_coverage)}')
+    if not docs.restrict(compatible.get):
+      sys.exit(f'No document in {args.path} has a font in {args.fonts} covering {args.min_coverage:.0%} of its lines')
+  jobs = (generate_job(docs, backgrounds, fonts, args.output_dir,
+                       args.min_spacing, args.max_spacing, args.min_dpi, args.max_dpi,
+                       args.warn, args.verbose, args.sample, args.window_lines,
+                       args.variants, args.variant_layouts, args.compositing, args.page_mode,
+                       compatible) for it in range(args.iters))
+  # the workers outlive single jobs, so imports, parsed fonts and backgrounds
+  # stay warm instead of being reloaded by a fresh interpreter per sample
+  stop = Event()
+  pool = Pool(processes=min(args.batch_size, cpu_count()),
+              initializer=init_worker,
+              initargs=(args, stop),
+              maxtasksperchild=args.max_jobs_per_worker)
+  stats_by_worker = {}
+  try:
+    for pid, stats in tqdm(pool.imap_unordered(run_job, jobs), total=args.iters, leave=False):
+      stats_by_worker[pid] = stats
+  except KeyboardInterrupt:
+    # queued jobs become no-ops and the workers exit normally, which
+    # flushes the pages they still have in their writer queues
+    print("Received KeyboardInterrupt. Flushing written pages, press Ctrl-C again to abort.")
+    stop.set()
+  pool.close()
+  pool.join()
+  if args.verbose:
+    for pid, stats in sorted(stats_by_worker.items()):
+      for name, summary in stats.items():
+        print(f'[INFO] Worker {pid} {name}: {summary}')
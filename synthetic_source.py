@@ -0,0 +1,96 @@
+# Synthetic text rendered straight from the generators in text-synthesis/,
+# without writing it to sources/synthesized/ first. A background thread
+# generates the text in chunks of words behind a bounded queue, so it stays
+# a few chunks ahead of the layout and stops once the layout has its pages.
+
+import os
+import queue
+import sys
+import threading
+from dataclasses import dataclass
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'text-synthesis'))
+
+from generators import GENERATORS, make_generator
+
+# more lines than any page holds, so a document whose font skips most of
+# the text still ends
+MAX_LINES_PER_PAGE = 1000
+
+class TextStream:
+  """Iterable over the lines a generator writes, ending in newlines like
+  those of a file. Close it to stop the generating thread."""
+  def __init__(self, generator, chunk_words=2000, max_queue=4):
+    self.generator = generator
+    self.chunk_words = chunk_words
+    self.queue = queue.Queue(maxsize=max_queue)
+    self.stopped = threading.Event()
+    self.words = 0
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def put(self, item):
+    while not self.stopped.is_set():
+      try:
+        self.queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def run(self):
+    rest = ''
+    try:
+      while not self.stopped.is_set():
+        *lines, rest = (rest + self.generator.generate_chunk(self.chunk_words)).split('\n')
+        self.words += self.chunk_words
+        self.put([f'{line}\n' for line in lines])
+    except Exception as e:
+      # raised again on the reading side
+      self.put(e)
+
+  def __iter__(self):
+    while True:
+      lines = self.queue.get()
+      if isinstance(lines, Exception):
+        raise lines
+      yield from lines
+
+  def close(self):
+    self.stopped.set()
+    self.thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+@dataclass
+class SyntheticSource:
+  "Stands in for a source file in a job, see random_generate.py"
+  generator: str
+  pages: int = 4
+  seed: object = None
+  chunk_words: int = 2000
+  max_queue: int = 4
+
+  @property
+  def name(self):
+    """What the rendered documents are named after. Their configs record the
+    generator and seed instead of a source path."""
+    return self.generator
+
+  @property
+  def max_lines(self):
+    return self.pages * MAX_LINES_PER_PAGE
+
+  def config_fields(self):
+    "What RenderConfigs of this source's documents record about it"
+    return {'generator': self.generator, 'seed': self.seed}
+
+  def sample(self, words=20000):
+    "Lines of a first chunk of text, e.g. to check fonts against"
+    return make_generator(self.generator, self.seed).generate_chunk(words).splitlines(keepends=True)
+
+  def open(self):
+    return TextStream(make_generator(self.generator, self.seed), self.chunk_words, self.max_queue)
@@ -0,0 +1,26 @@
+import glob
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FONT_DIRS = ['fonts.d', '/usr/share/fonts', '/usr/local/share/fonts', '/Library/Fonts']
+
+@pytest.fixture
+def font_path():
+  "A TrueType font with Latin glyphs, from the repo's fonts or the system's"
+  for font_dir in FONT_DIRS:
+    font_dir = os.path.join(ROOT, font_dir)
+    for path in sorted(glob.glob(os.path.join(font_dir, '**', '*.ttf'), recursive=True)):
+      if 'DejaVuSans.ttf' in path or font_dir.endswith('fonts.d'):
+        return path
+  pytest.skip('no font found')
+
+@pytest.fixture(autouse=True)
+def workdir(tmpdir, monkeypatch):
+  "Every test runs in its own folder, so caches under .cache/ start empty"
+  monkeypatch.chdir(tmpdir)
+  return tmpdir
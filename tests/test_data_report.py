@@ -0,0 +1,37 @@
+import json
+import os
+
+import data_report
+
+def write_output(dir_path, config):
+  os.makedirs(dir_path)
+  with open(os.path.join(dir_path, 'config.json'), 'w') as f:
+    json.dump(config, f)
+
+def test_output_with_missing_source_is_marked(workdir, font_path):
+  with open('source.txt', 'w') as f:
+    f.write('abc\n')
+  write_output('outputs/good.d', {'path': 'source.txt', 'font': font_path})
+  write_output('outputs/moved.d', {'path': 'gone/source.txt', 'font': font_path})
+  entries = data_report.audit(['outputs/good.d', 'outputs/moved.d'], processes=1)
+  assert entries['outputs/good.d'] == {'marked': False, 'incompatible': None}
+  assert entries['outputs/moved.d'] == {'marked': True, 'incompatible': None}
+
+def test_shard_record_with_missing_source_is_marked(workdir, font_path):
+  from outputs import ShardWriter
+  with open('source.txt', 'w') as f:
+    f.write('abc\n')
+  with ShardWriter('outputs', prefix='shard') as shards:
+    shards.add('good', {'png': b'', 'config.json': json.dumps({'path': 'source.txt', 'font': font_path}).encode()})
+    shards.add('moved', {'png': b'', 'config.json': json.dumps({'path': 'gone.txt', 'font': font_path}).encode()})
+  entries = data_report.audit([], ['outputs/shard-000000.tar'], processes=1)
+  assert entries['outputs/shard-000000.tar#good']['marked'] is False
+  assert entries['outputs/shard-000000.tar#moved']['marked'] is True
+
+def test_report_keeps_glob_order_over_runs():
+  marked = {'marked': True, 'incompatible': None}
+  # as after an incremental run: entries of earlier runs first
+  state = {'outputs/b.d': marked, 'outputs/s.tar#2': marked, 'outputs/s.tar#1': marked,
+           'outputs/a.d': marked, 'outputs/r.tar#1': marked}
+  report = data_report.build_report(['outputs/a.d', 'outputs/b.d'], {'outputs/s.tar', 'outputs/r.tar'}, state)
+  assert report['marked'] == ['outputs/a.d', 'outputs/b.d', 'outputs/r.tar#1', 'outputs/s.tar#2', 'outputs/s.tar#1']
@@ -0,0 +1,31 @@
+import glob
+import json
+import threading
+
+import pytest
+from PIL import features
+
+import data_report
+import random_generate
+from outputs import DirectoryOutput
+from synthetic_source import SyntheticSource
+from writer import SyncWriter
+
+@pytest.mark.skipif(not features.check('raqm'), reason='rendering needs libraqm')
+def test_synthesized_job_is_audited(workdir, font_path, monkeypatch):
+  monkeypatch.setattr(random_generate, 'page_writer', SyncWriter())
+  monkeypatch.setattr(random_generate, 'page_output', DirectoryOutput())
+  monkeypatch.setattr(random_generate, 'stop_event', threading.Event())
+  docs = SyntheticSource('numbers', pages=1, chunk_words=500)
+  job = random_generate.generate_job(docs, [None], [font_path], 'outputs', 1., 1., 72, 72, False, False)
+  random_generate.run_job(job)
+
+  [dir_] = glob.glob('outputs/*')
+  with open(f'{dir_}/config.json') as f:
+    config = json.load(f)
+  assert 'path' not in config
+  assert config['generator'] == 'numbers'
+  assert config['seed'] == job[0].seed
+
+  entries = data_report.audit([dir_], processes=1)
+  assert entries[dir_] == {'marked': False, 'incompatible': None}
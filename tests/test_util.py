@@ -0,0 +1,12 @@
+import demoji
+
+import util
+
+def test_emoji_removed_without_demoji_code_table(monkeypatch):
+  monkeypatch.delattr(demoji, '_CODE_TO_DESC', raising=False)
+  util._emoji_triggers.cache_clear()
+  try:
+    assert util._emoji_triggers() is None
+    assert util.real_preprocess('سلام #️⃣ عليكم') == util.real_preprocess('سلام  عليكم')
+  finally:
+    util._emoji_triggers.cache_clear()
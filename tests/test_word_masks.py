@@ -0,0 +1,26 @@
+import pytest
+from PIL import Image, ImageDraw, features
+
+import main
+import word_masks
+from font_cache import truetype
+
+pytestmark = pytest.mark.skipif(not features.check('raqm'), reason='rendering needs libraqm')
+
+def draw(text, font_path):
+  page = Image.new('RGBA', (400, 100), (230, 220, 200, 255))
+  main.draw_line(page, ImageDraw.Draw(page), (350.5, 30), text, truetype(font_path, 30), (0, 0, 0, 230), 'words')
+
+def test_line_without_words_is_not_sampled(font_path):
+  masks = word_masks.configure(sample_every=1)
+  for text in ('', '   ', '\u200f \u200f'):
+    draw(text, font_path)
+  assert masks.stats()['sampled'] == 0
+  assert masks.stats()['speedup'] is None
+  assert 'speedup' not in word_masks.format_stats(masks.stats())
+
+def test_line_with_words_is_sampled(font_path):
+  masks = word_masks.configure(sample_every=1)
+  draw('سلام عليكم', font_path)
+  assert masks.stats()['sampled'] == 1
+  assert masks.stats()['speedup'] > 0
@@ -7,17 +7,31 @@ class Generator:
     pass
   def generate(self):
     raise NotImplementedError
+  def generate_batch(self, n):
+    return [self.generate() for _ in range(n)]
+  def generate_chunk(self, n):
+    "Text of `n` generated words, ready to be appended to what came before"
+    return self.postprocess_text(''.join(map(self.postprocess_word, self.generate_batch(n))))
   def postprocess_text(self, text):
+    "Runs on every chunk, so must not need text from neighbouring chunks"
     return text
   def postprocess_word(self, word):
     return word
 
 class NumberGenerator(Generator):
-  def __init__(self, newline_prob=0.025, space_prob=0.3):
+  """Arabic-Indic digits, spaces and newlines.
+
+  Every word is a newline with probability `newline_prob`, a space up to
+  `space_prob` and otherwise digits: a single one, or with `group_lengths`
+  a group whose length is k + 1 with probability group_lengths[k].
+  """
+  def __init__(self, newline_prob=0.025, space_prob=0.3, group_lengths=None):
     self.alphabet = list('١٢٣٤٥٦٧٨٩٠')
     self.par_delimiter = '\n'
     self.newline_prob = newline_prob
     self.space_prob = space_prob
+    self.group_lengths = group_lengths
+    self.rng = np.random.default_rng()
     
   def generate(self):
     pull = random.random()
@@ -25,8 +39,41 @@ class NumberGenerator(Generator):
       return self.par_delimiter
     elif pull < self.space_prob:
       return ' '
-    else:
+    elif self.group_lengths is None:
       return random.choice(self.alphabet)
+    else:
+      length = random.choices(range(1, len(self.group_lengths) + 1), weights=self.group_lengths)[0]
+      return ''.join(random.choice(self.alphabet) for _ in range(length))
+
+  def _sample(self, n):
+    """Characters of `n` words drawn at once as code points, and the length
+    of each word"""
+    cuts = [self.newline_prob, max(self.space_prob, self.newline_prob)]
+    # 0 newline, 1 space, 2 digits
+    kinds = np.searchsorted(cuts, self.rng.random(n), side='right')
+    lengths = np.ones(n, dtype=np.int64)
+    if self.group_lengths is not None:
+      groups = kinds == 2
+      p = np.asarray(self.group_lengths, dtype=float)
+      lengths[groups] = self.rng.choice(np.arange(1, len(p) + 1), groups.sum(), p=p / p.sum())
+    kind_of_char = np.repeat(kinds, lengths)
+    table = np.array([ord(ch) for ch in [self.par_delimiter, ' ', *self.alphabet]], dtype=np.uint32)
+    codes = np.where(kind_of_char == 2,
+                     table[2 + self.rng.integers(len(self.alphabet), size=len(kind_of_char))],
+                     table[np.minimum(kind_of_char, 1)])
+    return codes, lengths
+
+  def generate_batch(self, n):
+    codes, lengths = self._sample(n)
+    text = codes.astype('<u4').tobytes().decode('utf-32-le')
+    ends = np.cumsum(lengths)
+    return [text[end - length:end] for end, length in zip(ends.tolist(), lengths.tolist())]
+
+  def generate_chunk(self, n):
+    # words are only concatenated, so the text is decoded from the code
+    # points in one go, without making a string per word
+    codes, _ = self._sample(n)
+    return self.postprocess_text(codes.astype('<u4').tobytes().decode('utf-32-le'))
 
 class PegonJawaGenerator(Generator):
   sukun = 'ْ'
@@ -117,7 +164,8 @@ class PegonJawaGenerator(Generator):
       'َي',
       self.pepet
     ]
-    self.vowels = list(set(self.short_vowels + self.long_vowels))
+    # in a fixed order, so seeded runs repeat
+    self.vowels = list(dict.fromkeys(self.short_vowels + self.long_vowels))
     
     self.initial_vowels = [
       'أ',
@@ -177,6 +225,28 @@ class PegonJawaGenerator(Generator):
       'َنَا',
     ]
     
+    # spelling fix-ups where syllables meet, applied in order
+    fixups = [
+      # ('َاَ', 'َااَ'), # this might not be possible to achieve anyway
+      ('َاَيْ', 'َائَيْ'),
+      ('َا' + self.pepet, 'َاا' + self.pepet),
+      ('َ(اِ|إ)(ي)?', 'َائِي'),
+      # ('َاَو', 'َاَو'),
+      ('َيْا', 'َيْئَا'),
+      ('َيْاَو', 'َيْئَو'),
+      ('َيْاُو', 'َيْئُو'),
+      (self.pepet + '(اِ|إ)(ي)?', self.pepet + 'ئِي'),
+      ('ِيْ(اَ|أ)', 'ِيَْا'),
+      ('ِيْ(اِ|إ)', 'ِيْئِي'),
+      ('ِيْاَو', 'ِيْئَو'),
+      ('َوْ(اَ|أ)', 'َوْوَا'),
+      ('ُوْ(اَ|أ)', 'ُوْوَا'),
+      ('ُوْاُو', 'ُؤُوْ'),
+      # ('', ''),
+    ]
+    self.fixups = [(re.compile(pattern), result) for pattern, result in fixups]
+    self._tables = None
+
   def hanuswara(self, word):
     try:
       return self.mutating_prefix[word[0]] + word[1:]
@@ -253,25 +323,8 @@ class PegonJawaGenerator(Generator):
         self._generate_vc,
         self._generate_v
       ], 1, p=[0.05, 0.1, 0.2, 0.5, 0.1, 0.05]).item()()
-    for pattern, result in [
-      # ('َاَ', 'َااَ'), # this might not be possible to achieve anyway
-      ('َاَيْ', 'َائَيْ'),
-      ('َا' + self.pepet, 'َاا' + self.pepet),
-      ('َ(اِ|إ)(ي)?', 'َائِي'),
-      # ('َاَو', 'َاَو'),
-      ('َيْا', 'َيْئَا'),
-      ('َيْاَو', 'َيْئَو'),
-      ('َيْاُو', 'َيْئُو'),
-      (self.pepet + '(اِ|إ)(ي)?', self.pepet + 'ئِي'),
-      ('ِيْ(اَ|أ)', 'ِيَْا'),
-      ('ِيْ(اِ|إ)', 'ِيْئِي'),
-      ('ِيْاَو', 'ِيْئَو'),
-      ('َوْ(اَ|أ)', 'َوْوَا'),
-      ('ُوْ(اَ|أ)', 'ُوْوَا'),
-      ('ُوْاُو', 'ُؤُوْ'),
-      # ('', ''),
-    ]:
-      word = re.sub(pattern, result, word)
+    for pattern, result in self.fixups:
+      word = pattern.sub(result, word)
     if random.random() < self.prefix_prob:
       word = self.prefix(word)
     if random.random() < self.suffix_prob:
@@ -285,8 +338,105 @@ class PegonJawaGenerator(Generator):
       return word + self.comma
     else:
       return word
+
+  def _syllable_tables(self):
+    """Every syllable each `_generate_*` template can return, one table
+    after the other in the order `generate` weighs them, with the start and
+    size of each. Drawing uniformly from a template's range is drawing each
+    of its parts uniformly."""
+    if self._tables is None:
+      sukun = self.sukun
+      templates = [
+        [f'{cs}{v}{c2}{sukun}' for cs in self.consonant_clusters for v in self.vowels for c2 in self.consonants],
+        [f'{cs}{v}{sukun}' for cs in self.consonant_clusters for v in self.long_vowels],
+        [f'{c}{v}{sukun}' for c in self.consonants for v in self.long_vowels],
+        [f'{c1}{v}{c2}{sukun}' for c1 in self.consonants for v in self.vowels for c2 in self.consonants],
+        [f'{v}{c}{sukun}' for v in self.initial_vowels for c in self.consonants],
+        [f'{v}{sukun if v.endswith("و") or v.endswith("ي") else ""}' for v in self.initial_vowels],
+      ]
+      sizes = np.array([len(template) for template in templates])
+      self._tables = (np.array(sum(templates, []), dtype=object),
+                      np.cumsum(sizes) - sizes, sizes)
+    return self._tables
+
+  def generate_batch(self, n):
+    """`n` words distributed as `n` calls to `generate`.
+
+    Every random choice of the batch is drawn at once from `self.rng` as
+    index arrays into precomputed tables, and each fix-up pattern runs once
+    over the whole batch. Only the words that get a prefix or a suffix are
+    touched one by one.
+    """
+    syllables, starts, sizes = self._syllable_tables()
+    rng = self.rng
+    num_syllables = rng.choice([1, 2, 3], n, p=(0.1, 0.85, 0.05))
+    templates = rng.choice(len(sizes), (3, n), p=[0.05, 0.1, 0.2, 0.5, 0.1, 0.05])
+    picked = syllables[starts[templates] + rng.integers(sizes[templates])]
+    words = picked[0] \
+      + np.where(num_syllables > 1, picked[1], '') \
+      + np.where(num_syllables > 2, picked[2], '')
+
+    # no pattern matches a newline, so none reaches from one word into the next
+    text = '\n'.join(words)
+    for pattern, result in self.fixups:
+      text = pattern.sub(result, text)
+    words = np.array(text.split('\n'), dtype=object)
+
+    prefixed = np.flatnonzero(rng.random(n) < self.prefix_prob)
+    kinds = rng.choice(3, len(prefixed), p=(0.3, 0.05, 0.65))
+    hanuswara = rng.choice(self.hanuswara_prefixes, len(prefixed))
+    tripurasa = rng.choice(['دَكْ', 'دِ'], len(prefixed))
+    liyane = rng.choice(self.liyane_prefixes, len(prefixed))
+    for i, kind, h, t, l in zip(prefixed, kinds, hanuswara, tripurasa, liyane):
+      word = words[i]
+      if kind == 0:
+        # as `hanuswara`
+        if word[0] in self.mutating_prefix:
+          word = self.mutating_prefix[word[0]] + word[1:]
+        elif word[0] in self.mutating_vowel_prefix:
+          word = h + self.mutating_vowel_prefix[word[0]] + word[1:]
+        else:
+          word = h + self.sukun + word
+      elif kind == 1:
+        word = t + word
+      else:
+        word = l + word
+      words[i] = word
+
+    suffixed = np.flatnonzero(rng.random(n) < self.suffix_prob)
+    # `panambang_vowel` replaces a final sukun, `panambang` keeps it
+    strip = rng.random(len(suffixed)) < 3/8
+    suffixes = rng.choice(self.panambang_vowel_suffixes, len(suffixed))
+    for i, strip_sukun, suffix in zip(suffixed, strip, suffixes):
+      word = words[i]
+      if strip_sukun and word.endswith(self.sukun):
+        word = word[:-1]
+      words[i] = word + suffix
+
+    pull = rng.random((3, n))
+    full_stop = pull[0] < self.full_stop_prob
+    newline = ~full_stop & (pull[1] < self.newline_prob)
+    comma = ~full_stop & ~newline & (pull[2] < self.comma_prob)
+    endings = np.full(n, '', dtype=object)
+    endings[full_stop] = self.full_stop
+    endings[newline] = self.par_delimiter
+    endings[comma] = self.comma
+    return [str(word) for word in words + endings]
     
   def postprocess_text(self, text):
     return text.replace(' ' + self.comma, self.comma).replace(' ' + self.full_stop, self.full_stop)
   def postprocess_word(self, word):
-    return word + (' ' if word != generator.par_delimiter else '')
+    return word + (' ' if word != self.par_delimiter else '')
+
+GENERATORS = {'numbers': NumberGenerator,
+              'pegon-jawa': PegonJawaGenerator}
+
+def make_generator(name, seed=None, **kwargs):
+  """The generator called `name`, made with `kwargs` and seeded from `seed`
+  (an int or a SeedSequence). Generators draw from both `random` and their
+  `rng`, so this also seeds this process's `random`."""
+  seed = np.random.SeedSequence(seed) if not isinstance(seed, np.random.SeedSequence) else seed
+  random.seed(int(seed.generate_state(1)[0]))
+  generator = GENERATORS[name](**kwargs)
+  generator.rng = np.random.default_rng(seed)
+  return generator
@@ -1,26 +1,73 @@
 #!/usr/bin/env python
-import random
-import numpy as np
-import os
-from tqdm import trange
-from generators import NumberGenerator, PegonJawaGenerator
+
+# Writes synthetic text files for the renderer. Files are spread over a pool
+# of processes, each generator seeded from its own child of one SeedSequence,
+# and every file is streamed to disk in chunks of words instead of being
+# built up in memory.
+
+import argparse
 import datetime
+import os
+import time
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+from tqdm import tqdm
+
+from generators import GENERATORS, make_generator
+
+def write_file(job):
+  """Generate one file of about `words` words, or `size` bytes when that is
+  set, `chunk_words` at a time. Returns words and bytes written and the
+  seconds it took."""
+  name, options, seed, words, size, chunk_words, filepath = job
+  start = time.perf_counter()
+  generator = make_generator(name, seed, **options)
+  written_words = written_bytes = 0
+  with open(f'{filepath}.tmp', 'wb') as f:
+    while (written_bytes < size) if size else (written_words < words):
+      n = chunk_words if size else min(chunk_words, words - written_words)
+      chunk = generator.generate_chunk(n).encode()
+      f.write(chunk)
+      written_words += n
+      written_bytes += len(chunk)
+  os.replace(f'{filepath}.tmp', filepath)
+  return written_words, written_bytes, time.perf_counter() - start
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Generate synthetic text files")
+  parser.add_argument('generator', choices=sorted(GENERATORS), help='Generator to draw words from')
+  parser.add_argument('--files', type=int, default=20, help='Number of files to write')
+  parser.add_argument('--words', type=int, nargs=2, default=[1000, 5000], metavar=('MIN', 'MAX'),
+                      help='Range the number of words of each file is drawn from')
+  parser.add_argument('--mb', type=float, default=None,
+                      help='Write this many MiB per file instead of a number of words')
+  parser.add_argument('--chunk-words', type=int, default=10000,
+                      help='Words generated and written at a time')
+  parser.add_argument('--digit-groups', type=float, nargs='+', default=None, metavar='P',
+                      help='numbers: weights of digit groups of 1, 2, ... digits instead of single digits')
+  parser.add_argument('--seed', type=int, default=None, help='Seed of the whole run')
+  parser.add_argument("--output-dir", "-o", type=str, default='../sources/synthesized',
+                      help="Path to output directory")
+  parser.add_argument('--batch-size', '-b', type=int, default=cpu_count(),
+                      help='Number of worker processes')
+  args = parser.parse_args()
+
+  os.makedirs(args.output_dir, exist_ok=True)
+  seeds = np.random.SeedSequence(args.seed)
+  sizes = np.random.default_rng(seeds).integers(args.words[0], args.words[1], args.files, endpoint=True)
+  stamp = datetime.datetime.now().timestamp()
+  options = {'group_lengths': args.digit_groups} if args.digit_groups else {}
+  jobs = [(args.generator, options, seed, int(words), int(args.mb * 2 ** 20) if args.mb else None, args.chunk_words,
+           os.path.join(args.output_dir, f'{args.generator}-{stamp}-{i:05d}.txt'))
+          for i, (seed, words) in enumerate(zip(seeds.spawn(args.files), sizes))]
 
-filedir = '../sources/synthesized/'
-os.makedirs(filedir, exist_ok=True)
-
-# generator = PegonJawaGenerator()
-# file_title = 'pegon-jawa'
-generator = NumberGenerator()
-file_title = 'numbers'
-iterations = 20
-
-for it in trange(iterations, leave=False):
-  generations = random.randint(1000, 5000)
-  filepath = os.path.join(filedir, f'{file_title}-{datetime.datetime.now().timestamp()}.txt')
-  text = ''
-  for i in trange(generations, leave=False):
-    text += generator.postprocess_word(generator.generate())
-  text = generator.postprocess_text(text)
-  with open(filepath, 'w') as file:
-    file.write(text)
+  start = time.perf_counter()
+  total_words = total_bytes = 0
+  with Pool(processes=min(args.batch_size, cpu_count())) as pool:
+    for words, size, _ in tqdm(pool.imap_unordered(write_file, jobs), total=len(jobs), leave=False):
+      total_words += words
+      total_bytes += size
+  elapsed = time.perf_counter() - start
+  print(f'{len(jobs)} files, {total_words} words, {total_bytes / 2 ** 20:.1f} MiB in {elapsed:.1f}s '
+        f'({total_words / elapsed:.0f} words/s) under \'{args.output_dir}\'')
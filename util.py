@@ -1,4 +1,5 @@
 import unicodedata
+from functools import lru_cache
 import demoji
 from arabic_reshaper import ArabicReshaper
 from bidi.algorithm import get_display
@@ -15,13 +16,55 @@ def remove_character_blocks(s, blocks=['C', 'S'],
     return "".join(ch for ch in s if (ch in exceptions) or (unicodedata.category(ch)[0] not in blocks))
 
 
+class _DeletionTable(dict):
+  """str.translate table deleting control and symbol characters, except
+  ZWNJ, and mapping ornate parentheses to plain ones. Each character's
+  category is looked up once and the decision kept."""
+  def __missing__(self, codepoint):
+    ch = chr(codepoint)
+    keep = ch == '\u200c' or unicodedata.category(ch)[0] not in 'CS'
+    self[codepoint] = codepoint if keep else None
+    return self[codepoint]
+
+_deletions = _DeletionTable({ord('﴾'): '(', ord('﴿'): ')'})
+
+@lru_cache(maxsize=None)
+def _emoji_triggers():
+  """Characters at least one of which is in every emoji demoji could still
+  find once control and symbol characters are gone.
+
+  Almost all emoji are symbols, what survives are keycaps, a few
+  punctuation marks and the variation selectors demoji also strips. Built
+  on first use from demoji's private code table, None if a demoji version
+  has none, and then every line goes through demoji.
+  """
+  load = getattr(demoji, 'set_emoji_pattern', None)
+  if load is not None:
+    load()
+  codes = getattr(demoji, '_CODE_TO_DESC', None)
+  if not codes:
+    return None
+  triggers = set('\ufe0e\ufe0f')
+  for code in codes:
+    if any(unicodedata.category(ch)[0] in 'CS' for ch in code):
+      continue
+    rare = {ch for ch in code if not ch.isascii()}
+    triggers |= rare or set(code)
+  return frozenset(triggers)
+
+_non_arabic_words = re.compile(r"[^\u0600-\u06ff\u0750-\u077f\uFE70-\uFEFF\uFB50-\uFDFF\u0870-\u089F\W\n]+\b")
+_leading_harakat = frozenset('\u064e\u064f\u0650\u064b\u064c\u064d\u0674')
+_lone_hamza = re.compile(r"\b[\u0621\u0674]\b")
+
 def real_preprocess(line):
-  line = remove_character_blocks(line)
-  line = line.replace('﴾', '(').replace('﴿', ')')
-  line = demoji.replace(line, '')
-  line = re.sub(r"[^\u0600-\u06ff\u0750-\u077f\uFE70-\uFEFF\uFB50-\uFDFF\u0870-\u089F\W\n]+\b", '' , line)
-  line = re.sub(r"^[\u064e\u064f\u0650\u064b\u064c\u064d\u0674]", '', line)
-  line = re.sub(r"\b[\u0621\u0674]\b", '', line)
+  line = line.translate(_deletions)
+  triggers = _emoji_triggers()
+  if triggers is None or not triggers.isdisjoint(line):
+    line = demoji.replace(line, '')
+  line = _non_arabic_words.sub('', line)
+  if line[:1] in _leading_harakat:
+    line = line[1:]
+  line = _lone_hamza.sub('', line)
   return line
 
 def render_preprocess(line):
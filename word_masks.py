@@ -0,0 +1,110 @@
+# Rasterized words, for drawing lines by blitting (--compositing words).
+# Arabic script only joins inside a word, so a right-to-left line looks the
+# same as its words drawn one by one from the right, each after the advances
+# of the words and spaces before it. Our corpora are dominated by a small
+# vocabulary, so most words of a line are already rasterized.
+#
+# Masks are kept per sub-pixel phase, rounded to 1/`phases` of a pixel.
+# FreeType positions glyphs in 1/64 of a pixel, so with the default of 64
+# phases a word's glyphs land on the same pixels as in full-line rendering.
+# Fewer phases share masks between more positions, at the price of glyphs
+# that sit close to a pixel boundary moving by one.
+# Kerning against spaces is ignored, and lines with left-to-right text are
+# drawn whole since the words of an LTR run are not ordered right to left.
+# `benchmark.py words` measures the difference to full-line rendering.
+#
+# Every `sample_every`-th line drawn from words is also drawn whole onto a
+# copy of its region, and both are timed, so every run reports how much
+# faster word masks were than full-line rendering on its own text.
+
+import math
+import unicodedata
+from collections import OrderedDict
+
+from PIL import Image
+
+DEFAULT_BUDGET_MB = 64
+DEFAULT_PHASES = 64
+DEFAULT_SAMPLE_EVERY = 50
+
+# bidi classes that reorder words within a right-to-left line
+LTR_CLASSES = frozenset(('L', 'LRE', 'LRO', 'LRI', 'RLE', 'RLO', 'RLI', 'FSI', 'PDF', 'PDI'))
+
+def splits_into_words(text):
+  "Whether `text` can be drawn word by word from the right"
+  return not any(unicodedata.bidirectional(ch) in LTR_CLASSES for ch in set(text))
+
+class WordMaskCache:
+  def __init__(self, budget_mb=DEFAULT_BUDGET_MB, phases=DEFAULT_PHASES, sample_every=DEFAULT_SAMPLE_EVERY):
+    self.budget = int(budget_mb * 2 ** 20)
+    self.phases = phases
+    self.sample_every = sample_every
+    self.entries = OrderedDict()
+    self.used = 0
+    self.hits = 0
+    self.misses = 0
+    self.lines = 0
+    self.sampled = 0
+    self.word_seconds = 0.
+    self.line_seconds = 0.
+
+  def sample_line(self):
+    "Whether the next line drawn from words is also to be timed drawn whole"
+    self.lines += 1
+    return bool(self.sample_every) and self.lines % self.sample_every == 0
+
+  def add_timing(self, word_seconds, line_seconds):
+    self.sampled += 1
+    self.word_seconds += word_seconds
+    self.line_seconds += line_seconds
+
+  def place(self, x):
+    "Whole pixel and quantized phase a word drawn at `x` is rasterized with"
+    whole = math.floor(x)
+    step = round((x - whole) * self.phases)
+    if step == self.phases:
+      whole, step = whole + 1, 0
+    return whole, step / self.phases
+
+  def get(self, font, word, phase_x, phase_y=0.):
+    """Coverage mask of `word` rasterized at the given sub-pixel phases and
+    its offset from the drawing position, as returned by `getmask2`"""
+    key = (font, word, phase_x, phase_y)
+    try:
+      entry = self.entries[key]
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry
+    except KeyError:
+      self.misses += 1
+    mask, offset = font.getmask2(word, 'L', direction="rtl", start=(phase_x, phase_y))
+    entry = Image.Image()._new(mask), offset
+    self.entries[key] = entry
+    self.used += entry[0].width * entry[0].height
+    while self.used > self.budget and len(self.entries) > 1:
+      _, (evicted, _) = self.entries.popitem(last=False)
+      self.used -= evicted.width * evicted.height
+    return entry
+
+  def stats(self):
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'cached': len(self.entries),
+            'mb': self.used / 2 ** 20,
+            'sampled': self.sampled,
+            'speedup': self.line_seconds / self.word_seconds if self.word_seconds else None}
+
+def format_stats(stats):
+  lookups = max(stats['hits'] + stats['misses'], 1)
+  text = f"{stats['hits'] / lookups:.1%} hit rate, {stats['hits']} hits/{stats['misses']} misses ({stats['cached']} cached, {stats['mb']:.0f} MiB)"
+  if stats.get('speedup') is not None:
+    text += f", {stats['speedup']:.2f}x speedup over whole lines on {stats['sampled']} sampled lines"
+  return text
+
+masks = WordMaskCache()
+
+def configure(budget_mb=DEFAULT_BUDGET_MB, phases=DEFAULT_PHASES, sample_every=DEFAULT_SAMPLE_EVERY):
+  "Replace this process's cache, e.g. from a worker initializer"
+  global masks
+  masks = WordMaskCache(budget_mb, phases, sample_every)
+  return masks
@@ -0,0 +1,131 @@
+# Writer stage for finished pages. Encoding and writing run on background
+# threads behind a bounded queue, so the render loop can move on to the next
+# page while earlier ones are compressed and written. PIL's PNG encoder and
+# file writes release the GIL, so threads are enough to overlap them with
+# rendering.
+
+import queue
+import sys
+import threading
+import time
+import traceback
+
+class AsyncWriter:
+  def __init__(self, threads=1, max_queue=8):
+    self.queue = queue.Queue(maxsize=max_queue)
+    self.lock = threading.Lock()
+    self.submitted = 0
+    self.failed = 0
+    self.depth_total = 0
+    self.depth_max = 0
+    self.wait_time = 0.
+    self.encode_time = 0.
+    self.write_time = 0.
+    self.threads = [threading.Thread(target=self.run, daemon=True)
+                    for _ in range(threads)]
+    for thread in self.threads:
+      thread.start()
+
+  def submit(self, encode, write):
+    """Queue `write(encode())`, blocking while the queue is full.
+
+    Time spent blocked here is time the renderer waited on the writer.
+    """
+    depth = self.queue.qsize()
+    start = time.perf_counter()
+    self.queue.put((encode, write))
+    self.wait_time += time.perf_counter() - start
+    self.submitted += 1
+    self.depth_total += depth
+    self.depth_max = max(self.depth_max, depth)
+
+  def run(self):
+    while True:
+      task = self.queue.get()
+      if task is None:
+        self.queue.task_done()
+        return
+      encode, write = task
+      try:
+        start = time.perf_counter()
+        payload = encode()
+        encoded = time.perf_counter()
+        write(payload)
+        with self.lock:
+          self.encode_time += encoded - start
+          self.write_time += time.perf_counter() - encoded
+      except Exception:
+        with self.lock:
+          self.failed += 1
+        print('[WARN] Failed to write a page:', file=sys.stderr)
+        traceback.print_exc()
+      finally:
+        self.queue.task_done()
+
+  def flush(self):
+    "Block until every queued page is written"
+    self.queue.join()
+
+  def close(self):
+    if not self.threads:
+      return
+    for _ in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    self.threads = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def stats(self):
+    return {'pages': self.submitted,
+            'failed': self.failed,
+            'mean depth': self.depth_total / max(self.submitted, 1),
+            'max depth': self.depth_max,
+            'encode s': self.encode_time,
+            'write s': self.write_time,
+            'wait s': self.wait_time}
+
+class SyncWriter:
+  "Same interface, but encodes and writes on the calling thread"
+  def __init__(self):
+    self.submitted = 0
+    self.encode_time = 0.
+    self.write_time = 0.
+
+  def submit(self, encode, write):
+    start = time.perf_counter()
+    payload = encode()
+    encoded = time.perf_counter()
+    write(payload)
+    self.encode_time += encoded - start
+    self.write_time += time.perf_counter() - encoded
+    self.submitted += 1
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def stats(self):
+    return {'pages': self.submitted,
+            'encode s': self.encode_time,
+            'write s': self.write_time}
+
+def make_writer(threads=1, max_queue=8):
+  return AsyncWriter(threads, max_queue) if threads > 0 else SyncWriter()
+
+def format_stats(stats):
+  return ', '.join(f'{name} {value:.2f}' if isinstance(value, float) else f'{name} {value}'
+                   for name, value in stats.items())